@@ -1,44 +1,82 @@
 #!/usr/bin/env python3
-from PIL import Image
+from blend_core import (
+    ENGINE_VERSION,
+    Print,
+    Profiler,
+    RecolourTable,
+    RecolourWriter,
+    Spritemap,
+    copyright,
+    format_recolour_data,
+    profiler,
+    write_recolour,
+    write_recolour_files,
+)
+from contextlib import nullcontext
+import numpy as np
 import sys
-from typing import Union
-
-
-class Print:
-    colours = {"red": "\033[91m", "yellow": "\033[93m", "reset": "\033[0m"}
-
-    @staticmethod
-    def error(*message, sep=" "):
-        sys.stderr.write(
-            f"{Print.colours['red']}Error: {sep.join(map(str, message))}{Print.colours['reset']}\n"
-        )
-        sys.exit(1)
-
-    @staticmethod
-    def warn(*message, sep=" "):
-        sys.stderr.write(
-            f"{Print.colours['yellow']}Warning: {sep.join(map(str, message))}{Print.colours['reset']}\n"
-        )
-
-    @staticmethod
-    def info(*message, sep=" "):
-        sys.stdout.write(f"{sep.join(map(str, message))}\n")
-
-    @staticmethod
-    # does not print anything but colours the message
-    def colour(message, colour):
-        return f"{Print.colours[colour]}{message}{Print.colours['reset']}"
+import time
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# what moved to blend_core is still exported from here, scripts and tools
+# written against blend.py import it from this module
+__all__ = [
+    "ENGINE_VERSION",
+    "Print",
+    "Profiler",
+    "RecolourTable",
+    "RecolourWriter",
+    "Spritemap",
+    "copyright",
+    "format_recolour_data",
+    "profiler",
+    "write_recolour",
+    "write_recolour_files",
+    "ProcessImage",
+    "ProcessedImage",
+    "RESERVED_RANGES",
+    "PaletteSlots",
+    "CompareImage",
+    "BlendImages",
+    "gen_recolour_sprite",
+    "predict_colours",
+    "read_header",
+    "size_problem",
+    "check_same_size",
+    "check_inputs",
+    "load_images",
+    "process_image",
+    "chain_step",
+    "verify_blend",
+    "verify_message",
+    "check_round_trip",
+    "write_image",
+    "finish_profile",
+    "run",
+    "main",
+]
 
 
 class ProcessImage:
-    def __init__(self, image_path):
+    def __init__(self, image_path, decode_cache=None):
         self.image_path = image_path
+        self.decode_cache = decode_cache
         self._image = None
         self._spritemap = None
+        self._palette = None
         self._used_colours = None
         self._size = None
 
     def _load_image(self):
+        with profiler.stage("decode"):
+            return self._decode_image()
+
+    def _decode_image(self):
+        from PIL import Image
+
         try:
             with Image.open(self.image_path) as img:
                 if img.mode != "P":
@@ -48,13 +86,20 @@ class ProcessImage:
             Print.error(f"failed to load image, {type(e).__name__}, {e}")
 
     def _load_spritemap(self):
-        width, height = self.image.size
-        pixels = list(self.image.getdata())
-        return tuple(tuple(pixels[i * width : (i + 1) * width]) for i in range(height))
+        image = self.image
+        width, height = self._size = image.size
+        if self._palette is None:
+            self._palette = image.getpalette()
+        with profiler.stage("spritemap"):
+            spritemap = Spritemap(image.tobytes(), width, height)
+        # everything else is read from the spritemap, don't hold every input
+        # twice for the rest of the blend
+        self._image = None
+        return spritemap
 
     @staticmethod
-    def get_used_colours(spritemap: tuple) -> set:
-        return set(pix for row in spritemap for pix in row)
+    def get_used_colours(spritemap: Spritemap) -> set:
+        return set(spritemap.data)
 
     @property
     def image(self):
@@ -62,12 +107,36 @@ class ProcessImage:
             self._image = self._load_image()
         return self._image
 
+    def _load_decoded(self):
+        # spritemap and palette come from the decode cache when it has them,
+        # otherwise the png is decoded and the result handed to the cache
+        cached = None
+        if self.decode_cache is not None:
+            cached = self.decode_cache.load(self.image_path)
+        if cached is None:
+            cached = (self._load_spritemap(), self._palette)
+            if self.decode_cache is not None:
+                self.decode_cache.store(self.image_path, *cached)
+        self._spritemap, self._palette = cached
+
     @property
     def spritemap(self):
         if self._spritemap is None:
-            self._spritemap = self._load_spritemap()
+            if self.decode_cache is not None:
+                self._load_decoded()
+            else:
+                self._spritemap = self._load_spritemap()
         return self._spritemap
 
+    @property
+    def palette(self):
+        if self._palette is None:
+            if self.decode_cache is not None:
+                self._load_decoded()
+            else:
+                self._palette = self.image.getpalette()
+        return self._palette
+
     @property
     def used_colours(self):
         if self._used_colours is None:
@@ -77,7 +146,10 @@ class ProcessImage:
     @property
     def size(self):
         if self._size is None:
-            self._size = self.image.size
+            if self.decode_cache is not None:
+                self._size = self.spritemap.size
+            else:
+                self._size = self.image.size
         return self._size
 
 
@@ -97,20 +169,90 @@ class ProcessedImage:
     @property
     def size(self):
         if self._size is None:
-            self._size = (len(self.spritemap[0]), len(self.spritemap))
+            self._size = self.spritemap.size
         return self._size
 
 
+# named index ranges of the OpenTTD (DOS) palette for --reserve
+RESERVED_RANGES = {
+    "transparent": range(0, 1),
+    "company": range(0xC6, 0xCE),
+    "company2": range(0x50, 0x58),
+    "animated": range(0xE3, 0xFF),
+}
+
+
+class PaletteSlots:
+    # hands out free palette indices, lowest first, in O(1) each. Indices
+    # taken by colours that both inputs of a step use, and reserved ones, are
+    # never handed out. Every engine allocates through this, so they all agree
+    def __init__(self, taken: set, reserved: frozenset = frozenset()):
+        self.free = [
+            index
+            for index in range(256)
+            if index not in taken and index not in reserved
+        ]
+        self.next = 0
+
+    def allocate(self) -> int:
+        if self.next == len(self.free):
+            Print.error("impossible to process as image requires more than 256 colours")
+        index = self.free[self.next]
+        self.next += 1
+        return index
+
+    @staticmethod
+    def needed(taken: set, reserved: frozenset, new_colours: int) -> int:
+        # palette slots a step takes, the blend fits while this is <= 256
+        return len(taken | reserved) + new_colours
+
+    @staticmethod
+    def parse(text: str) -> frozenset:
+        # "0,198-205" or names from RESERVED_RANGES, e.g. "transparent,company"
+        reserved = set()
+        for part in text.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if part in RESERVED_RANGES:
+                reserved.update(RESERVED_RANGES[part])
+                continue
+            first, _, last = part.partition("-")
+            first = int(first, 0)
+            last = int(last, 0) if last else first
+            if not 0 <= first <= last <= 255:
+                raise ValueError(f"{part} is not a range of palette indices")
+            reserved.update(range(first, last + 1))
+        return frozenset(reserved)
+
+    @staticmethod
+    def parse_reserve(text: str) -> frozenset:
+        # the value of --reserve, like parse but at least one index is needed
+        try:
+            indices = PaletteSlots.parse(text)
+        except ValueError:
+            indices = None
+        if not indices:
+            raise ValueError(
+                "expected palette indices, e.g. 0,198-205 or"
+                f" {','.join(RESERVED_RANGES)}"
+            )
+        return indices
+
+
 class CompareImage:
-    def __init__(self, patient1, patient2):
-        if not patient1.size == patient2.size:
-            Print.info(patient1.size, patient2.size)
+    def __init__(self, patient1, patient2, engine="pairkey", reserved=frozenset()):
+        check_same_size([patient1, patient2])
+
+        if engine not in self.engines:
             Print.error(
-                f"Images {patient1.image_path} and {patient2.image_path} are not the same size"
+                f"Unknown engine {engine}, choose from {', '.join(self.engines)}"
             )
 
         self.patient1 = patient1
         self.patient2 = patient2
+        self.engine = engine
+        self.reserved = reserved
 
         self._rec_info = None
         self._spritemap = None
@@ -122,7 +264,11 @@ class CompareImage:
     @property
     def rec_info(self):
         if self._rec_info is None:
-            self._rec_info = self.get_recinfo(self.patient1, self.patient2)
+            get_recinfo = getattr(self, self.engines[self.engine])
+            with profiler.stage("recinfo"):
+                self._rec_info = get_recinfo(
+                    self.patient1, self.patient2, self.reserved
+                )
         return self._rec_info
 
     @property
@@ -134,13 +280,13 @@ class CompareImage:
     @property
     def recolour_dict1(self):
         if self._recolour_dict1 is None:
-            self._spritemap, self._recolour_dict_1, self._recolour_dict2 = self.rec_info
+            self._spritemap, self._recolour_dict1, self._recolour_dict2 = self.rec_info
         return self._recolour_dict1
 
     @property
     def recolour_dict2(self):
         if self._recolour_dict2 is None:
-            self._spritemap, self._recolour_dict_1, self._recolour_dict2 = self.rec_info
+            self._spritemap, self._recolour_dict1, self._recolour_dict2 = self.rec_info
         return self._recolour_dict2
 
     @property
@@ -160,21 +306,80 @@ class CompareImage:
             )
         return self._estimated_colour_count
 
+    # engine name -> method implementing the (spritemap, rec1, rec2) contract
+    engines = {"pairkey": "get_recinfo_pairkey", "reference": "get_recinfo"}
+
+    @staticmethod
+    def assign_pairs(
+        keys: np.ndarray,
+        first_index: np.ndarray,
+        used_colours1: set,
+        used_colours2: set,
+        reserved: frozenset = frozenset(),
+    ) -> tuple[np.ndarray, RecolourTable, RecolourTable]:
+        # keys are the sorted unique colour1 * 256 + colour2 pairs, returns the
+        # output index of every pair along with both recolour dicts
+        colours1 = (keys >> 8).tolist()
+        colours2 = (keys & 0xFF).tolist()
+
+        # visit pairs in the same order as get_recinfo (by image 1 colour in
+        # set order, then by first occurrence) so all engines agree on indices
+        rank = np.zeros(256, dtype=np.intp)
+        rank[list(used_colours1)] = np.arange(len(used_colours1))
+        order = np.lexsort((first_index, rank[keys >> 8]))
+
+        recolour_dict1 = bytearray(RecolourTable.identity)
+        recolour_dict2 = bytearray(RecolourTable.identity)
+        lookup = np.empty(len(keys), dtype=np.uint8)
+
+        slots = PaletteSlots(used_colours1 & used_colours2, reserved)
+        for pair in order.tolist():
+            colour1, colour2 = colours1[pair], colours2[pair]
+            if colour1 == colour2:
+                lookup[pair] = colour1
+                continue
+            new_colour = slots.allocate()
+            lookup[pair] = new_colour
+            recolour_dict1[new_colour] = colour1
+            recolour_dict2[new_colour] = colour2
+
+        return (lookup, RecolourTable(recolour_dict1), RecolourTable(recolour_dict2))
+
+    @staticmethod
+    def get_recinfo_pairkey(
+        image1: Union[ProcessImage, ProcessedImage],
+        image2: Union[ProcessImage, ProcessedImage],
+        reserved: frozenset = frozenset(),
+    ) -> tuple[Spritemap, RecolourTable, RecolourTable]:
+        # every pixel becomes a colour1 * 256 + colour2 key, one unique pass
+        # gives each distinct pair, where it first occurs and which pixels use it
+        width, height = image1.size
+        plane1 = image1.spritemap.array().ravel().astype(np.uint16)
+        plane2 = image2.spritemap.array().ravel()
+        keys, first_index, inverse = np.unique(
+            plane1 * 256 + plane2, return_index=True, return_inverse=True
+        )
+        lookup, recolour_dict1, recolour_dict2 = CompareImage.assign_pairs(
+            keys, first_index, image1.used_colours, image2.used_colours, reserved
+        )
+
+        new_spritemap = Spritemap(lookup[inverse.ravel()], width, height)
+        return (new_spritemap, recolour_dict1, recolour_dict2)
+
     @staticmethod
     def get_recinfo(
         image1: Union[ProcessImage, ProcessedImage],
         image2: Union[ProcessImage, ProcessedImage],
-    ) -> tuple[tuple, dict, dict]:
+        reserved: frozenset = frozenset(),
+    ) -> tuple[Spritemap, RecolourTable, RecolourTable]:
         # data initialization
-        new_spritemap = [
-            [0 for _ in range(len(image1.spritemap[0]))]
-            for _ in range(len(image1.spritemap))
-        ]
-        recolour_dict1 = {_: _ for _ in range(256)}
-        recolour_dict2 = {_: _ for _ in range(256)}
+        width, height = image1.size
+        new_spritemap = bytearray(width * height)
+        recolour_dict1 = bytearray(RecolourTable.identity)
+        recolour_dict2 = bytearray(RecolourTable.identity)
         processed_coords = set()
 
-        common_colours = image1.used_colours & image2.used_colours
+        slots = PaletteSlots(image1.used_colours & image2.used_colours, reserved)
 
         for colour1 in image1.used_colours:
             coords1 = tuple(
@@ -197,138 +402,594 @@ class CompareImage:
                 processed_coords |= final_coords
                 if colour1 == colour2:
                     for coord in final_coords:
-                        new_spritemap[coord[0]][coord[1]] = colour1
+                        new_spritemap[coord[0] * width + coord[1]] = colour1
                 else:
-                    new_colour = 0
-                    while new_colour in common_colours:
-                        new_colour += 1
-                        if new_colour > 255:
-                            Print.error(
-                                "impossible to process as image requires more than 256 colours"
-                            )
-                    common_colours |= {new_colour}
+                    new_colour = slots.allocate()
                     for coord in final_coords:
-                        new_spritemap[coord[0]][coord[1]] = new_colour
+                        new_spritemap[coord[0] * width + coord[1]] = new_colour
                     recolour_dict1[new_colour] = colour1
                     recolour_dict2[new_colour] = colour2
 
-        return (tuple(new_spritemap), recolour_dict1, recolour_dict2)
+        return (
+            Spritemap(new_spritemap, width, height),
+            RecolourTable(recolour_dict1),
+            RecolourTable(recolour_dict2),
+        )
 
 
-def gen_recolour_sprite(rec1, rec2):
-    rec_copy = rec1.copy()
-    for dkey, dval in rec2.items():
-        rec_copy[dkey] = rec1[dval]
+class BlendImages:
+    def __init__(self, patients, reserved=frozenset()):
+        if len(patients) < 2:
+            Print.error("Please provide at least two images to blend")
+        check_same_size(patients)
 
-    return rec_copy
+        self.patients = patients
+        self.reserved = reserved
 
+        self._rec_info = None
+        self._used_colours = None
 
-def process_image(image_paths: list[str]) -> tuple:
-    images = [ProcessImage(image_path) for image_path in image_paths]
-    new_image = CompareImage(images[0], images[1])
-    Print.info(
-        f"Estimated colours: {new_image.estimated_colour_count[0]}-{new_image.estimated_colour_count[1]}"
-    )
-    Print.info(f"Actual           : {new_image.used_colours}")
-    spritemap = new_image.spritemap
-    rec1 = new_image.recolour_dict1
-    rec2 = new_image.recolour_dict2
+    @property
+    def rec_info(self):
+        if self._rec_info is None:
+            with profiler.stage("recinfo"):
+                self._rec_info = self.get_recinfo(self.patients, self.reserved)
+        return self._rec_info
 
-    recolour_sprites = {image_paths[0]: rec1.copy(), image_paths[1]: rec2.copy()}
-    processed = ProcessedImage(spritemap)
+    @property
+    def spritemap(self):
+        return self.rec_info[0]
 
-    for i in range(2, len(images)):
-        new_image = CompareImage(processed, images[i])
-        Print.info(
-            f"Estimated colours: {new_image.estimated_colour_count[0]}-{new_image.estimated_colour_count[1]}"
-        )
-        Print.info(f"Actual           : {new_image.used_colours}")
-        processed.spritemap = new_image.spritemap
+    @property
+    def recolour_dicts(self):
+        return self.rec_info[1]
 
-        for key, recolour_sprite in recolour_sprites.items():
-            recolour_sprites[key] = gen_recolour_sprite(
-                recolour_sprite, new_image.recolour_dict1
-            )
+    @property
+    def used_colours(self):
+        if self._used_colours is None:
+            self._used_colours = len(ProcessImage.get_used_colours(self.spritemap))
+        return self._used_colours
 
-        recolour_sprites[image_paths[i]] = new_image.recolour_dict2
+    @staticmethod
+    def _ordered_colours(colours: np.ndarray, by_first: np.ndarray) -> set:
+        # a set fed in first occurrence order iterates exactly like one built
+        # from the whole spritemap, which the pair ordering relies on
+        return set(colours[by_first].tolist())
 
-    return (processed.spritemap, images[0].image.getpalette(), recolour_sprites)
+    @staticmethod
+    def distinct_tuples(
+        images: list[Union[ProcessImage, ProcessedImage]], return_inverse: bool = True
+    ) -> tuple:
+        # the distinct per-pixel (colour0, ..., colourN) tuples, the pixel each
+        # first occurs at and, if asked for, which tuple every pixel is
+        planes = np.stack(
+            [image.spritemap.array().ravel() for image in images],
+            axis=1,
+        )
+        if len(images) <= 8:
+            # up to 8 colours pack into one big-endian integer per pixel, which
+            # sorts like the tuple and is far faster to unique than rows
+            packed = np.zeros(len(planes), dtype=np.uint64)
+            for i in range(len(images)):
+                packed = (packed << np.uint64(8)) | planes[:, i]
+            unique = np.unique(packed, return_index=True, return_inverse=return_inverse)
+            first_index = unique[1]
+            tuples = planes[first_index]
+        else:
+            unique = np.unique(
+                planes, axis=0, return_index=True, return_inverse=return_inverse
+            )
+            tuples, first_index = unique[:2]
+        inverse = unique[2] if return_inverse else None
+        return (tuples, first_index, inverse, len(planes))
 
+    @staticmethod
+    def chain_tuples(
+        tuples: np.ndarray,
+        first_index: np.ndarray,
+        pixels: int,
+        reserved: frozenset = frozenset(),
+        stop_on_overflow: bool = False,
+    ) -> tuple[np.ndarray, list, int]:
+        # every step of the pairwise chain, touching only the distinct tuples.
+        # Returns the output colour of each tuple, the recolour tables of each
+        # step and the most palette slots a step needed, see PaletteSlots. With
+        # stop_on_overflow the chain stops before a step that needs more than
+        # 256 instead of failing in it
+        by_first = np.argsort(first_index)
+        current = tuples[:, 0].astype(np.uint16)
+        steps = []
+        slots = 0
+        for i in range(1, tuples.shape[1]):
+            colours2 = tuples[:, i].astype(np.uint16)
+            keys, pair_inverse = np.unique(
+                current * 256 + colours2, return_inverse=True
+            )
+            pair_first = np.full(len(keys), pixels)
+            np.minimum.at(pair_first, pair_inverse, first_index)
+            used_colours1 = BlendImages._ordered_colours(current, by_first)
+            used_colours2 = BlendImages._ordered_colours(colours2, by_first)
+            step_slots = PaletteSlots.needed(
+                used_colours1 & used_colours2,
+                reserved,
+                int(np.count_nonzero((keys >> 8) != (keys & 0xFF))),
+            )
+            slots = max(slots, step_slots)
+            if stop_on_overflow and step_slots > 256:
+                break
+            lookup, recolour_dict1, recolour_dict2 = CompareImage.assign_pairs(
+                keys, pair_first, used_colours1, used_colours2, reserved
+            )
+            current = lookup[pair_inverse].astype(np.uint16)
+            steps.append((recolour_dict1, recolour_dict2))
+        return (current, steps, slots)
 
-def write_image(filename: str, data: tuple, palette: Image.Palette) -> None:
-    new_image = Image.new("P", (len(data[0]), len(data)))
-    new_image.putdata([item for sublist in data for item in sublist])
-    new_image.putpalette(palette)
-    new_image.save(filename)
+    @staticmethod
+    def get_recinfo(
+        images: list[Union[ProcessImage, ProcessedImage]],
+        reserved: frozenset = frozenset(),
+    ) -> tuple[Spritemap, list[RecolourTable]]:
+        # one pass over the per-pixel tuples, after which every step of the
+        # pairwise chain only touches the distinct tuples
+        width, height = images[0].size
+        tuples, first_index, inverse, pixels = BlendImages.distinct_tuples(images)
+        current, steps, _ = BlendImages.chain_tuples(
+            tuples, first_index, pixels, reserved
+        )
+        new_spritemap = current[inverse.ravel()].astype(np.uint8)
+        return (
+            Spritemap(new_spritemap, width, height),
+            BlendImages.chain_recolour_dicts(steps),
+        )
 
+    @staticmethod
+    def predict(
+        images: list[Union[ProcessImage, ProcessedImage]],
+        reserved: frozenset = frozenset(),
+    ) -> tuple[int, int]:
+        # (colours, slots) of blending the images, without building anything.
+        # Every engine hands out the same indices, so this is exact for all of
+        # them: colours is the number of distinct tuples, which is what the
+        # output uses, and the blend fits when slots is at most 256
+        with profiler.stage("predict"):
+            tuples, first_index, _, pixels = BlendImages.distinct_tuples(
+                images, return_inverse=False
+            )
+            _, _, slots = BlendImages.chain_tuples(
+                tuples, first_index, pixels, reserved, stop_on_overflow=True
+            )
+        return (len(tuples), slots)
 
-def format_recolour_data(recolour_data: dict[dict]) -> dict:
-    f = {}
-    for name, rec in recolour_data.items():
-        s = ""
-        s += "recolour_sprite {"
-        s += f"\n    // {name}"
-        counter = 0
-        for key, value in rec.items():
-            if key == value:
-                continue
-            if counter % 8 == 0:
-                s += "\n    "
-            s += f"0x{key:02x}:0x{value:02x};"
-            counter += 1
-        s += "\n}\n"
-        Print.info(f"Used colours: {counter} ({name})")
-        f[name] = s
-    return f
+    @staticmethod
+    def chain_recolour_dicts(
+        steps: list[tuple[RecolourTable, RecolourTable]],
+    ) -> list[RecolourTable]:
+        with profiler.stage("compose"):
+            return BlendImages._chain_recolour_dicts(steps)
 
+    @staticmethod
+    def _chain_recolour_dicts(
+        steps: list[tuple[RecolourTable, RecolourTable]],
+    ) -> list[RecolourTable]:
+        # the pairwise chain composes every earlier table with each later
+        # table1, so image i ends up with table2 of its step followed by table1
+        # of all later steps. Composing from the last step backwards does it once
+        chain = RecolourTable()
+        recolour_dicts = []
+        for recolour_dict1, recolour_dict2 in reversed(steps):
+            recolour_dicts.append(recolour_dict2.compose(chain))
+            chain = recolour_dict1.compose(chain)
+        recolour_dicts.append(chain)
+        recolour_dicts.reverse()
+        return recolour_dicts
+
+
+def gen_recolour_sprite(rec1, rec2) -> RecolourTable:
+    return RecolourTable.of(rec1).compose(RecolourTable.of(rec2))
+
+
+def predict_colours(
+    image_paths: list[str],
+    decode_cache=None,
+    reserved: frozenset = frozenset(),
+    images: list = None,
+) -> tuple[int, int]:
+    # see BlendImages.predict, any subset of images can be tried this way.
+    # `images` are the ProcessImages of `image_paths` if they are already at hand
+    if images is None:
+        images = [ProcessImage(image_path, decode_cache) for image_path in image_paths]
+    check_same_size(images)
+    return BlendImages.predict(images, reserved)
+
+
+def read_header(image_path: str) -> tuple:
+    # size, mode and raw palette, Image.open only reads the header chunks and
+    # decodes no pixels until they are asked for
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        palette = img.palette.getdata()[1] if img.palette is not None else None
+        return (img.size, img.mode, palette)
+
+
+def size_problem(image_path1: str, size1: tuple, image_path2: str, size2: tuple) -> str:
+    return (
+        f"Images {image_path1} and {image_path2} are not the same size"
+        f" ({size1[0]}x{size1[1]} and {size2[0]}x{size2[1]})"
+    )
 
-def write_recolour(filename: str, recolour_data: dict[dict]) -> None:
-    with open(filename, "w+") as f:
-        for rec in format_recolour_data(recolour_data).values():
-            f.write(rec)
-    Print.info(f"Recolour data written to {filename}")
 
+def check_same_size(images: list) -> None:
+    # every blend needs its inputs in one size
+    for image in images[1:]:
+        if image.size != images[0].size:
+            Print.error(
+                size_problem(
+                    images[0].image_path, images[0].size, image.image_path, image.size
+                )
+            )
 
-def copyright():
-    from datetime import datetime
 
-    Print.info("blend.py - A tool to blend multiple images together")
-    Print.info(f"Copyright 2024-{datetime.now().year} WenSim <wensimehrp@gmail.com>")
-    Print.info("Licensed under the MIT License")
-    Print.info("")
+def check_inputs(image_paths: list[str], headers: dict = None) -> list[str]:
+    # every problem that would make blending these images fail or come out
+    # wrong, found from their headers alone. `headers` keeps what was read
+    # across calls, so images shared between jobs are opened once
+    if headers is None:
+        headers = {}
+    problems = []
+    if len(image_paths) < 2:
+        problems.append("Please provide at least two images to blend")
+    first = None
+    for image_path in image_paths:
+        if image_path not in headers:
+            try:
+                headers[image_path] = read_header(image_path)
+            except Exception as e:
+                headers[image_path] = (
+                    f"failed to load image {image_path}, {type(e).__name__}, {e}"
+                )
+        header = headers[image_path]
+        if isinstance(header, str):
+            problems.append(header)
+            continue
+        size, mode, palette = header
+        # greyscale has no palette to write the output with
+        if mode != "P":
+            problems.append(f"Image {image_path} is in {mode} mode, not indexed")
+        if first is None:
+            first = (image_path, size, palette)
+            continue
+        if size != first[1]:
+            problems.append(size_problem(first[0], first[1], image_path, size))
+        # the output takes the first palette, the shared entries must agree
+        if palette is not None and first[2] is not None:
+            shared = min(len(palette), len(first[2]))
+            if palette[:shared] != first[2][:shared]:
+                problems.append(
+                    f"Images {first[0]} and {image_path} have different palettes"
+                )
+    return problems
+
+
+def load_images(image_paths: list[str], decode_cache=None) -> list:
+    # every input decoded on the loader threads and kept, for callers that
+    # need the images again after the blend (--verify)
+    from blend_loader import LOADER_THREADS, ImageLoader
+
+    threads = max(1, min(len(image_paths), LOADER_THREADS))
+    with ImageLoader(threads, decode_cache=decode_cache) as loader:
+        return list(loader.load(image_paths))
+
+
+def process_image(
+    image_paths: list[str],
+    engine: str = "pairkey",
+    nway: bool = False,
+    decode_cache=None,
+    reserved: frozenset = frozenset(),
+    images: list = None,
+) -> tuple:
+    # the inputs decode together on loader threads and the chain takes each
+    # one as soon as it is ready. `images` are the ProcessImages of
+    # `image_paths` if something before (optimize_order) already decoded them
+    from blend_loader import LOADER_THREADS, ImageLoader
+
+    loader = None
+    if images is None:
+        threads = max(1, min(len(image_paths), LOADER_THREADS))
+        loader = ImageLoader(threads, decode_cache=decode_cache)
+        images = loader.load(image_paths)
+    with loader or nullcontext():
+        images = iter(images)
+        if nway:
+            images = list(images)
+            blended = BlendImages(images, reserved)
+            Print.info(f"Actual           : {blended.used_colours}")
+            recolour_sprites = dict(zip(image_paths, blended.recolour_dicts))
+            return (blended.spritemap, images[0].palette, recolour_sprites)
+
+        first = next(images)
+        processed = first
+        recolour_sprites = {image_paths[0]: RecolourTable()}
+        for image_path, image in zip(image_paths[1:], images):
+            processed, recolour_sprites = chain_step(
+                processed, recolour_sprites, image, image_path, engine, reserved
+            )
+        return (processed.spritemap, first.palette, recolour_sprites)
+
+
+def chain_step(
+    processed,
+    recolour_sprites: dict,
+    image,
+    image_path: str,
+    engine: str = "pairkey",
+    reserved: frozenset = frozenset(),
+) -> tuple:
+    # blends one more image into the pairwise chain, returns the blend so far
+    # and the recolour sprites of every image in it
+    new_image = CompareImage(processed, image, engine, reserved)
+    Print.info(
+        f"Estimated colours: {new_image.estimated_colour_count[0]}-{new_image.estimated_colour_count[1]}"
+    )
+    Print.info(f"Actual           : {new_image.used_colours}")
 
+    with profiler.stage("compose"):
+        composed = RecolourTable.compose_all(
+            list(recolour_sprites.values()), new_image.recolour_dict1
+        )
+        recolour_sprites = dict(zip(recolour_sprites, composed))
+    recolour_sprites[image_path] = new_image.recolour_dict2
+
+    # a fresh ProcessedImage, the old one caches stale used colours
+    return (ProcessedImage(new_image.spritemap), recolour_sprites)
+
+
+def verify_blend(
+    image_paths: list[str],
+    spritemap: Spritemap,
+    recolour_sprites: dict,
+    decode_cache=None,
+    limit: int = 5,
+    images: list = None,
+) -> dict:
+    # applies every recolour table to the output with one lookup and compares
+    # the result with the input it was made for. Returns, for every image that
+    # doesn't come back, the number of wrong pixels and the first `limit` of
+    # them as (x, y, expected, got). `images` are the ProcessImages of
+    # `image_paths` if the caller still holds them, otherwise each is decoded
+    failures = {}
+    if images is None:
+        images = (ProcessImage(image_path, decode_cache) for image_path in image_paths)
+    with profiler.stage("verify"):
+        for image_path, image in zip(image_paths, images):
+            if image_path not in recolour_sprites or image.size != spritemap.size:
+                failures[image_path] = (spritemap.width * spritemap.height, [])
+                continue
+            expected = image.spritemap.array().ravel()
+            table = RecolourTable.of(recolour_sprites[image_path])
+            restored = table.apply(spritemap).array().ravel()
+            wrong = np.flatnonzero(restored != expected)
+            if len(wrong):
+                failures[image_path] = (
+                    len(wrong),
+                    [
+                        (
+                            int(i % spritemap.width),
+                            int(i // spritemap.width),
+                            int(expected[i]),
+                            int(restored[i]),
+                        )
+                        for i in wrong[:limit]
+                    ],
+                )
+    return failures
 
-def main():
-    import time
 
+def verify_message(failures: dict) -> str:
+    lines = []
+    for image_path, (count, pixels) in failures.items():
+        line = f"{image_path} doesn't round-trip, {count} pixels differ"
+        if pixels:
+            line += ", first " + ", ".join(
+                f"({x}, {y}) expected {expected} got {got}"
+                for x, y, expected, got in pixels
+            )
+        lines.append(line)
+    return "\n       ".join(lines)
+
+
+def check_round_trip(
+    image_paths: list[str],
+    spritemap: Spritemap,
+    recolour_sprites: dict,
+    decode_cache=None,
+    images: list = None,
+) -> None:
+    failures = verify_blend(
+        image_paths, spritemap, recolour_sprites, decode_cache, images=images
+    )
+    if failures:
+        Print.error(verify_message(failures))
+    Print.info(f"Verified         : all {len(image_paths)} images round-trip")
+
+
+def write_image(
+    filename: str,
+    data: Spritemap,
+    palette: "Image.Palette",
+    compress_level: int = None,
+    optimize: bool = False,
+    trim_palette: bool = False,
+) -> None:
+    # compress_level 0 (fastest) to 9 (smallest), PIL's 6 when None; optimize
+    # spends more time on a smaller file still. trim_palette drops the palette
+    # entries past the highest index used, indices stay as they are so the
+    # recolour sprites still apply, and below 17 entries the PNG also gets a
+    # lower bit depth
+    from PIL import Image
+
+    with profiler.stage("encode"):
+        new_image = Image.frombytes("P", data.size, data.data)
+        if trim_palette:
+            palette = palette[: 3 * (int(data.array().max(initial=0)) + 1)]
+        new_image.putpalette(palette)
+        options = {"optimize": optimize}
+        if compress_level is not None:
+            options["compress_level"] = compress_level
+        new_image.save(filename, **options)
+
+
+def finish_profile(profile: str, files: list[str]) -> None:
+    if profile is None:
+        return
+    profiler.stop()
+    Print.info("Stages:")
+    Profiler.print_stages(profiler.stages)
+    profiler.write("profile.json", " ".join(files))
+
+
+def run(
+    files: list[str],
+    *,
+    output: str = "output.png",
+    recolour: str = "recolour.txt",
+    engine: str = "pairkey",
+    nway: bool = False,
+    cache_dir: str = None,
+    cache_size: int = None,
+    decode_cache_dir: str = None,
+    decode_cache_clear: bool = False,
+    decode_cache_info: bool = False,
+    memory_budget: int = None,
+    profile: str = None,
+    dry_run: bool = False,
+    reserved: frozenset = frozenset(),
+    optimize_seconds: float = None,
+    verify: bool = False,
+    compress_level: int = None,
+    optimize_png: bool = False,
+    trim_palette: bool = False,
+) -> None:
+    # blends `files` in the order given (or the one --optimize-order finds)
+    # into `output` and `recolour`
     start = time.time()
 
-    copyright()
-
-    if len(sys.argv) < 2:
-        Print.error(
-            "Please provide at least one image to process\nUsage: blend.py <image1> <image2> ..."
-        )
-        sys.exit(1)
-
-    if sys.argv[1] in ("-h", "--help", "-?"):
-        Print.info("Usage: blend.py <image1> <image2> ...")
+    decode_cache = None
+    if decode_cache_dir is not None:
+        from blend_cache import DecodeCache
+
+        decode_cache = DecodeCache(decode_cache_dir)
+        if decode_cache_clear:
+            decode_cache.clear()
+            Print.info(f"Decode cache {decode_cache_dir} cleared")
+        if decode_cache_info:
+            decode_cache.report()
+    elif decode_cache_clear or decode_cache_info:
+        Print.error("--clear and --info require --decode-cache")
+    if not files and (decode_cache_clear or decode_cache_info):
         sys.exit(0)
 
-    if len(sys.argv) > 3:
+    if len(files) > 2:
         Print.warn(
             "You are processing more than 3 images, this may use a lot of colours"
         )
 
-    files = sys.argv[1:]
+    # fail on bad inputs before anything is decoded, and on all of them at once
+    problems = check_inputs(files)
+    if problems:
+        Print.error(*problems, sep="\n       ")
 
-    spritemap, palette, recs = process_image(files)
-    write_image("output.png", spritemap, palette)
-    write_recolour("recolour.txt", recs)
+    if profile is not None:
+        profiler.start(profile.split(","))
+
+    if memory_budget is not None:
+        if cache_dir is not None:
+            Print.error("--memory-budget can't be combined with --cache")
+        if optimize_seconds is not None:
+            Print.error(
+                "--memory-budget can't be combined with --optimize-order,"
+                " the search holds every input decoded"
+            )
+    cache = None
+    if cache_dir is not None and not dry_run:
+        from blend_cache import ResultCache, DEFAULT_CACHE_SIZE
+
+        cache = ResultCache(cache_dir, cache_size or DEFAULT_CACHE_SIZE)
+
+    if optimize_seconds is not None:
+        if cache is not None:
+            # a known order is looked up before anything is decoded
+            files, images = cache.optimize_order(
+                files, optimize_seconds, decode_cache, reserved
+            )
+        else:
+            from blend_order import optimize_order
+
+            files, images = optimize_order(
+                files, optimize_seconds, decode_cache, reserved
+            )
+    elif verify and not dry_run and memory_budget is None:
+        # decoded once for both the blend and the check
+        images = load_images(files, decode_cache)
+    else:
+        images = None
+
+    if dry_run:
+        colours, slots = predict_colours(files, decode_cache, reserved, images)
+        finish_profile(profile, files)
+        Print.info(f"Colours          : {colours}")
+        Print.info(f"Palette slots    : {slots} of 256")
+        if slots > 256:
+            Print.error("impossible to process as image requires more than 256 colours")
+        Print.info("The blend fits, nothing was written (--dry-run)")
+        return
+
+    if memory_budget is not None:
+        from blend_stream import stream_blend
+
+        if optimize_png or trim_palette:
+            Print.warn(
+                "--optimize-png and --trim-palette don't apply with --memory-budget,"
+                " the output is written before all of it is known"
+            )
+        recs = stream_blend(
+            files, output, memory_budget, decode_cache, reserved, compress_level
+        )
+        write_recolour(recolour, recs)
+        if verify:
+            # the output only exists on disk, check what was written
+            check_round_trip(files, ProcessImage(output).spritemap, recs, decode_cache)
+        finish_profile(profile, files)
+        Print.info("Finished processing images")
+        Print.info(f"Time taken: {time.time() - start:.2f}s")
+        return
+
+    if cache is not None:
+        spritemap, palette, recs = cache.process_image(
+            files, engine, nway, decode_cache, reserved, images
+        )
+    else:
+        spritemap, palette, recs = process_image(
+            files, engine, nway, decode_cache, reserved, images
+        )
+    write_image(output, spritemap, palette, compress_level, optimize_png, trim_palette)
+    write_recolour(recolour, recs)
+    if verify:
+        check_round_trip(files, spritemap, recs, decode_cache, images)
+    if cache is not None:
+        cache.report()
+    finish_profile(profile, files)
 
     Print.info("Finished processing images")
     Print.info(f"Time taken: {time.time() - start:.2f}s")
 
 
+def main():
+    from blend_cli import script
+
+    script("blend")
+
+
 if __name__ == "__main__":
     main()
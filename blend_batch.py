@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+from blend import (
+    PaletteSlots,
+    Print,
+    Profiler,
+    RecolourTable,
+    Spritemap,
+    check_inputs,
+    check_round_trip,
+    load_images,
+    predict_colours,
+    process_image,
+    profiler,
+    write_image,
+    write_recolour_files,
+)
+from blend_loader import PREFETCH_JOBS, Prefetcher
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+# threads in the main process writing the blended images while the workers
+# go on blending, 0 leaves encoding to the workers
+ENCODERS = 2
+
+
+def load_manifest(path: str, reserved: frozenset = frozenset()) -> list[dict]:
+    try:
+        if path.endswith(".toml"):
+            import tomllib
+
+            with open(path, "rb") as f:
+                manifest = tomllib.load(f)
+        else:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+    except Exception as e:
+        Print.error(f"failed to load manifest, {type(e).__name__}, {e}")
+
+    jobs = []
+    for i, job in enumerate(manifest.get("jobs", [])):
+        for key in ("inputs", "output", "recolour"):
+            if key not in job:
+                Print.error(f"job {i} in {path} is missing '{key}'")
+        # reserved indices are given like --reserve, "0,198-205", and add to it
+        try:
+            job_reserved = reserved | PaletteSlots.parse(job.get("reserve", ""))
+        except ValueError as e:
+            Print.error(f"job {i} in {path} has a bad 'reserve', {e}")
+        jobs.append(
+            {
+                "name": job.get("name", job["output"]),
+                "inputs": list(job["inputs"]),
+                "output": job["output"],
+                "recolour": job["recolour"],
+                "engine": job.get("engine", "pairkey"),
+                "nway": job.get("nway", False),
+                "reserved": job_reserved,
+                "optimize_order": job.get("optimize_order"),
+            }
+        )
+    return jobs
+
+
+def check_jobs(jobs: list[dict]) -> list[list[str]]:
+    # header problems of every job, each input is read once however many jobs
+    # use it
+    headers = {}
+    return [check_inputs(job["inputs"], headers) for job in jobs]
+
+
+def file_identities(image_paths: list[str]) -> dict[str, str]:
+    # a string per path that is equal only for files with equal contents.
+    # Files of a size no other file has can't equal any other, their size is
+    # enough. Only files sharing a size with another file are read and hashed,
+    # a path given twice (or a hard link) is one file
+    stats = {image_path: os.stat(image_path) for image_path in image_paths}
+    sizes = {}
+    for stat in stats.values():
+        sizes.setdefault(stat.st_size, set()).add((stat.st_dev, stat.st_ino))
+    digests = {}
+    identities = {}
+    for image_path, stat in stats.items():
+        file = (stat.st_dev, stat.st_ino)
+        if len(sizes[stat.st_size]) == 1:
+            identities[image_path] = f"size {stat.st_size}"
+            continue
+        if file not in digests:
+            with open(image_path, "rb") as f:
+                digests[file] = hashlib.blake2b(f.read()).hexdigest()
+        identities[image_path] = digests[file]
+    return identities
+
+
+def job_key(job: dict, identities: dict) -> str:
+    # jobs blending the same file contents in the same order with the same
+    # settings give the same result. The engines all agree, so that isn't part
+    # of it. `identities` comes from file_identities
+    return json.dumps(
+        [
+            sorted(job["reserved"]),
+            job["optimize_order"],
+            [identities[image_path] for image_path in job["inputs"]],
+        ]
+    )
+
+
+def dedup_jobs(jobs: list[dict], indices: list[int]) -> dict[int, int]:
+    # maps every job in `indices` that repeats an earlier one to that job
+    identities = file_identities(
+        [image_path for i in indices for image_path in jobs[i]["inputs"]]
+    )
+    first = {}
+    duplicates = {}
+    for i in indices:
+        key = job_key(jobs[i], identities)
+        if key in first:
+            duplicates[i] = first[key]
+        else:
+            first[key] = i
+    return duplicates
+
+
+def reuse_result(job: dict, original: dict, result: dict, dry_run: bool) -> dict:
+    # the result of `original` for the identical `job`, with its own output
+    # written and recolour sprites named after its own inputs
+    reused = {
+        "name": job["name"],
+        "ok": result["ok"],
+        "error": result["error"],
+        "seconds": 0.0,
+        "log": "",
+        "duplicate_of": original["name"],
+    }
+    if "prediction" in result:
+        reused["prediction"] = result["prediction"]
+    if result["ok"] and not dry_run:
+        if job["output"] != original["output"]:
+            try:
+                shutil.copyfile(original["output"], job["output"])
+            except OSError as e:
+                reused["ok"] = False
+                reused["error"] = (
+                    f"failed to write {job['output']}, {type(e).__name__}, {e}"
+                )
+                return reused
+        names = dict(zip(original["inputs"], job["inputs"]))
+        reused["recolour"] = {
+            names[name]: rec for name, rec in result["recolour"].items()
+        }
+    return reused
+
+
+def _error_message(log: str) -> str:
+    # Print.error writes a coloured "Error: ..." message right before exiting,
+    # the lines of a longer message are joined up
+    if "Error: " not in log:
+        return "job exited without an error message"
+    message = re.sub(r"\033\[\d+m", "", log.rsplit("Error: ", 1)[1])
+    return "; ".join(line.strip() for line in message.splitlines() if line.strip())
+
+
+def run_job(
+    job: dict,
+    cache: tuple = None,
+    decode_cache: str = None,
+    profile: str = None,
+    dry_run: bool = False,
+    verify: bool = False,
+    png: dict = None,
+    encode: bool = True,
+) -> dict:
+    # without `encode` the blended image comes back in the result for the
+    # main process to write, see encode_result
+    start = time.time()
+    log = io.StringIO()
+    result = {"name": job["name"], "ok": False, "error": None}
+    result_cache = None
+    if profile is not None:
+        profiler.start(profile.split(","))
+    try:
+        with redirect_stdout(log), redirect_stderr(log):
+            if decode_cache is not None:
+                from blend_cache import DecodeCache
+
+                decode_cache = DecodeCache(decode_cache)
+            inputs = job["inputs"]
+            images = None
+            if cache is not None and not dry_run:
+                from blend_cache import ResultCache
+
+                result_cache = ResultCache(*cache)
+            if job["optimize_order"] is not None:
+                if result_cache is not None:
+                    # a known order is looked up before anything is decoded
+                    inputs, images = result_cache.optimize_order(
+                        inputs, job["optimize_order"], decode_cache, job["reserved"]
+                    )
+                else:
+                    from blend_order import optimize_order
+
+                    inputs, images = optimize_order(
+                        inputs, job["optimize_order"], decode_cache, job["reserved"]
+                    )
+            elif verify and not dry_run:
+                # decoded once for both the blend and the check
+                images = load_images(inputs, decode_cache)
+            if dry_run:
+                colours, slots = predict_colours(
+                    inputs, decode_cache, job["reserved"], images
+                )
+            else:
+                if result_cache is not None:
+                    spritemap, palette, recs = result_cache.process_image(
+                        inputs,
+                        job["engine"],
+                        job["nway"],
+                        decode_cache,
+                        job["reserved"],
+                        images,
+                    )
+                else:
+                    spritemap, palette, recs = process_image(
+                        inputs,
+                        job["engine"],
+                        job["nway"],
+                        decode_cache,
+                        job["reserved"],
+                        images,
+                    )
+                if encode:
+                    write_image(job["output"], spritemap, palette, **(png or {}))
+                if verify:
+                    check_round_trip(inputs, spritemap, recs, decode_cache, images)
+        if dry_run:
+            result["prediction"] = (colours, slots)
+            result["ok"] = slots <= 256
+            if not result["ok"]:
+                result["error"] = (
+                    "impossible to process as image requires more than 256 colours"
+                )
+        else:
+            # recolour sprites are written by the main process, jobs may share
+            # a file
+            result["recolour"] = recs
+            result["ok"] = True
+            if not encode:
+                result["image"] = (spritemap.tobytes(), spritemap.size, palette)
+    except SystemExit:
+        # Print.error exits, that must only fail this job and not the batch
+        result["error"] = _error_message(log.getvalue())
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}, {e}"
+    if profile is not None:
+        profiler.stop()
+        result["profile"] = profiler.report(job["name"])
+        if result["ok"] and not dry_run:
+            with redirect_stdout(log):
+                profiler.write(f"{job['output']}.profile.json", job["name"])
+    if result_cache is not None:
+        result["cache"] = (
+            result_cache.hits,
+            result_cache.misses,
+            result_cache.evictions,
+        )
+    result["seconds"] = time.time() - start
+    result["log"] = log.getvalue()
+    return result
+
+
+def encode_result(job: dict, result: dict, png: dict = None) -> None:
+    # writes a job's image on an encoder thread of the main process, so the
+    # worker that blended it is already on its next job. zlib runs without
+    # the GIL, the threads compress in parallel
+    data, (width, height), palette = result.pop("image")
+    start = time.time()
+    try:
+        write_image(job["output"], Spritemap(data, width, height), palette, **png)
+    except Exception as e:
+        result["ok"] = False
+        result["error"] = f"failed to write {job['output']}, {type(e).__name__}, {e}"
+        # without its image the job's recolour sprites must not be written
+        result.pop("recolour", None)
+    seconds = time.time() - start
+    result["seconds"] += seconds
+    if "profile" in result:
+        result["profile"]["stages"]["encode"] = {
+            "calls": 1,
+            "seconds": seconds,
+            "self_seconds": seconds,
+        }
+
+
+def run_batch(
+    jobs: list[dict],
+    workers: int = None,
+    cache: tuple = None,
+    decode_cache: str = None,
+    profile: str = None,
+    dry_run: bool = False,
+    verify: bool = False,
+    png: dict = None,
+    encoders: int = ENCODERS,
+    prefetch: int = PREFETCH_JOBS,
+) -> list[dict]:
+    png = png or {}
+    results = [None] * len(jobs)
+    encode = dry_run or not encoders
+    encoding = []
+    reported = []
+    lock = threading.Lock()
+
+    def report(i: int) -> None:
+        # one progress line per finished job, from the main process or the
+        # encoder thread that wrote its image
+        with lock:
+            reported.append(i)
+            status = "ok" if results[i]["ok"] else Print.colour("FAILED", "red")
+            line = f"[{len(reported)}/{len(jobs)}] {status} {results[i]['name']}"
+            if "prediction" in results[i]:
+                line += " ({} colours, {} of 256 slots)".format(
+                    *results[i]["prediction"]
+                )
+            Print.info(line)
+
+    # the inputs of the running jobs and `prefetch` more are read ahead, with
+    # a decode cache the workers map planes and don't read the pngs at all
+    ahead = 0
+    if prefetch and decode_cache is None:
+        ahead = (workers or os.cpu_count() or 1) + prefetch
+    with ProcessPoolExecutor(max_workers=workers) as executor, ThreadPoolExecutor(
+        max_workers=max(1, encoders)
+    ) as encoder, Prefetcher(jobs, ahead) as prefetcher:
+        futures = {
+            executor.submit(
+                run_job, job, cache, decode_cache, profile, dry_run, verify, png, encode
+            ): i
+            for i, job in enumerate(jobs)
+        }
+        # the first submit forks the workers, the prefetch threads only start
+        # after that so no worker is forked from a threaded process
+        prefetcher.advance(0)
+        for done, future in enumerate(as_completed(futures), 1):
+            prefetcher.advance(done)
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except BaseException as e:
+                # the worker itself died, e.g. killed or out of memory
+                results[i] = {
+                    "name": jobs[i]["name"],
+                    "ok": False,
+                    "error": f"{type(e).__name__}, {e}",
+                    "seconds": 0.0,
+                    "log": "",
+                }
+            if "image" in results[i]:
+                # reported once the PNG is written, a failed write fails the job
+                encoding.append(encoder.submit(encode_result, jobs[i], results[i], png))
+                encoding[-1].add_done_callback(lambda _, i=i: report(i))
+            else:
+                report(i)
+        # outputs must all be on disk before identical jobs copy them
+        for future in encoding:
+            future.result()
+    return results
+
+
+def write_recolours(jobs: list[dict], results: list[dict]) -> None:
+    # jobs naming the same recolour file end up in one include, in manifest order
+    recolour_files = {}
+    for job, result in zip(jobs, results):
+        if "recolour" in result:
+            recolour_files.setdefault(job["recolour"], []).append(result["recolour"])
+    write_recolour_files(recolour_files)
+
+
+def write_recolour_index(jobs: list[dict], results: list[dict], index: str) -> None:
+    # every distinct recolour table is written once, into the recolour file of
+    # the first job using it, under its hash. The index tells the build which
+    # table each input of each job uses and which file it is in
+    tables = {}
+    recolour_files = {}
+    index_jobs = []
+    total = 0
+    for job, result in zip(jobs, results):
+        if "recolour" not in result:
+            continue
+        # a job's file is written even when all its tables are elsewhere, so
+        # nothing stale is left in it
+        recolour_files.setdefault(job["recolour"], {})
+        references = {}
+        for name, rec in result["recolour"].items():
+            table = RecolourTable.of(rec)
+            table_id = hashlib.blake2b(table.data, digest_size=8).hexdigest()
+            if table_id not in tables:
+                tables[table_id] = {
+                    "file": job["recolour"],
+                    "entries": len(table.changes()),
+                }
+                recolour_files[job["recolour"]][table_id] = table
+            references[name] = table_id
+            total += 1
+        index_jobs.append(
+            {
+                "name": job["name"],
+                "output": job["output"],
+                "recolour": job["recolour"],
+                "tables": references,
+            }
+        )
+    write_recolour_files({name: [data] for name, data in recolour_files.items()})
+    with open(index, "w+") as f:
+        json.dump({"tables": tables, "jobs": index_jobs}, f, indent=4)
+    Print.info(f"Recolour tables: {len(tables)} unique of {total}, index in {index}")
+
+
+def print_summary(results: list[dict]) -> None:
+    failed = [result for result in results if not result["ok"]]
+    Print.info("")
+    Print.info(f"Succeeded: {len(results) - len(failed)}")
+    Print.info(f"Failed   : {len(failed)}")
+    for result in failed:
+        Print.info(f"  {result['name']}: {result['error']}")
+    duplicates = sum("duplicate_of" in result for result in results)
+    if duplicates:
+        Print.info(f"Identical jobs reusing a result: {duplicates}")
+    cached = [result["cache"] for result in results if "cache" in result]
+    if cached:
+        hits, misses, evictions = map(sum, zip(*cached))
+        Print.info(f"Cache: {hits} hits, {misses} misses, {evictions} evicted")
+    profiles = [result["profile"] for result in results if "profile" in result]
+    if profiles:
+        Print.info("Stages over all jobs:")
+        Profiler.print_stages(Profiler.merge(profiles))
+
+
+def run(
+    manifest: str,
+    *,
+    workers: int = None,
+    cache_dir: str = None,
+    cache_size: int = None,
+    decode_cache: str = None,
+    profile: str = None,
+    dry_run: bool = False,
+    reserved: frozenset = frozenset(),
+    recolour_index: str = None,
+    verify: bool = False,
+    png: dict = None,
+    encoders: int = None,
+    prefetch: int = None,
+) -> None:
+    # runs every job of the manifest, exits with 1 when any of them failed
+    start = time.time()
+    if encoders is None:
+        encoders = ENCODERS
+    if prefetch is None:
+        prefetch = PREFETCH_JOBS
+
+    jobs = load_manifest(manifest, reserved)
+    problems = check_jobs(jobs)
+    valid = [i for i, job_problems in enumerate(problems) if not job_problems]
+    if len(valid) < len(jobs):
+        Print.warn(
+            f"{len(jobs) - len(valid)} of {len(jobs)} jobs failed the header checks"
+            " and won't be run"
+        )
+    duplicates = dedup_jobs(jobs, valid)
+    valid = [i for i in valid if i not in duplicates]
+    Print.info(f"Running {len(valid)} jobs")
+    if duplicates:
+        Print.info(f"{len(duplicates)} jobs repeat another job and reuse its result")
+    cache = None
+    if cache_dir is not None:
+        from blend_cache import DEFAULT_CACHE_SIZE
+
+        cache = (cache_dir, cache_size or DEFAULT_CACHE_SIZE)
+    results = [
+        {
+            "name": job["name"],
+            "ok": False,
+            "error": "; ".join(job_problems),
+            "seconds": 0.0,
+            "log": "",
+        }
+        for job, job_problems in zip(jobs, problems)
+    ]
+    valid_results = run_batch(
+        [jobs[i] for i in valid],
+        workers,
+        cache,
+        decode_cache,
+        profile,
+        dry_run,
+        verify,
+        png,
+        encoders,
+        prefetch,
+    )
+    for i, result in zip(valid, valid_results):
+        results[i] = result
+    for i, original in duplicates.items():
+        results[i] = reuse_result(jobs[i], jobs[original], results[original], dry_run)
+    if recolour_index is not None and not dry_run:
+        write_recolour_index(jobs, results, recolour_index)
+    elif not dry_run:
+        write_recolours(jobs, results)
+    print_summary(results)
+
+    Print.info(f"Time taken: {time.time() - start:.2f}s")
+    if any(not result["ok"] for result in results):
+        sys.exit(1)
+
+
+def main():
+    from blend_cli import script
+
+    script("batch")
+
+
+if __name__ == "__main__":
+    main()
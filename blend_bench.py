@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+from blend import (
+    BlendImages,
+    CompareImage,
+    Print,
+    ProcessImage,
+    format_recolour_data,
+    gen_recolour_sprite,
+    process_image,
+    write_image,
+    write_recolour,
+)
+from PIL import Image
+from contextlib import redirect_stdout
+import io
+import json
+import numpy as np
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = (64, 256, 1024)
+VARIANTS = (2, 4, 8)
+COLOURS = 48
+CORRELATION = 0.75
+# the reference engine scans the sheet once per colour pair, keep it small
+REFERENCE_MAX_SIZE = 64
+# modules whose import time the startup benchmarks track
+STARTUP_MODULES = ("blend_cli", "blend_core", "blend_compose", "blend")
+
+
+def generate_images(
+    directory: str,
+    size: int,
+    colours: int = COLOURS,
+    correlation: float = CORRELATION,
+    variants: int = 2,
+    seed: int = 0,
+) -> list[str]:
+    # a base sprite of `colours` indices in blocky shapes on a transparent
+    # background, each variant recolours the share of colours not covered by
+    # `correlation` (like a livery) and gets a few stray pixels on top, so the
+    # blend stays within 256 colours at every size
+    rng = np.random.default_rng(seed)
+    used = rng.choice(np.arange(1, 256), size=colours, replace=False)
+    block = max(1, size // 16)
+    shape = (size // block + 1, size // block + 1)
+    base = used[rng.integers(0, colours, shape)]
+    base[rng.random(shape) < 0.2] = 0
+    base = np.kron(base, np.ones((block, block), dtype=base.dtype))[:size, :size]
+
+    palette = rng.integers(0, 256, 256 * 3).tolist()
+    paths = []
+    for i in range(variants):
+        mapping = np.arange(256)
+        if i:
+            changed = rng.random(colours) >= correlation
+            mapping[used[changed]] = rng.choice(used, size=changed.sum())
+        plane = mapping[base]
+        if i:
+            noise = int(colours * (1 - correlation))
+            rows, columns = rng.integers(0, size, (2, noise))
+            plane[rows, columns] = rng.choice(used, size=noise)
+        image = Image.fromarray(plane.astype(np.uint8), "P")
+        image.putpalette(palette)
+        path = os.path.join(
+            directory, f"s{size}_c{colours}_r{correlation}_v{variants}_{i}.png"
+        )
+        image.save(path)
+        paths.append(path)
+    return paths
+
+
+def measure(function, repeat: int, number: int = 1) -> float:
+    # best of `repeat` runs, per call
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        seconds = (time.perf_counter() - start) / number
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def import_seconds(module: str, repeat: int) -> float:
+    # the cumulative time `python -X importtime` reports for importing
+    # `module`, best of `repeat` fresh interpreters
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        seconds = None
+        for line in result.stderr.splitlines():
+            # "import time: self [us] | cumulative | imported package"
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                seconds = int(fields[1]) / 1_000_000
+        if seconds is None:
+            Print.error(f"failed to import {module}, {result.stderr.strip()}")
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def startup_benchmarks():
+    # a whole interpreter running the CLI, what every build step pays before
+    # any blending starts
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blend_cli.py")
+    for command in ("blend", "compose"):
+        yield (
+            f"startup/cli/{command}",
+            lambda command=command: subprocess.run(
+                [sys.executable, cli, command, "--help"],
+                capture_output=True,
+                check=True,
+            ),
+            1,
+        )
+
+
+def stage_benchmarks(directory: str, size: int):
+    paths = generate_images(directory, size)
+    images = [ProcessImage(path) for path in paths]
+    for image in images:
+        image.used_colours
+    blended = CompareImage(images[0], images[1])
+    blended.spritemap
+    recs = {paths[0]: blended.recolour_dict1, paths[1]: blended.recolour_dict2}
+    output = os.path.join(directory, "bench_output.png")
+    name = f"{size}x{size}"
+
+    yield f"decode/{name}", lambda: ProcessImage(paths[0]).spritemap, 1
+    for engine in CompareImage.engines:
+        if engine == "reference" and size > REFERENCE_MAX_SIZE:
+            continue
+        yield (
+            f"recinfo/{engine}/{name}",
+            lambda engine=engine: CompareImage(images[0], images[1], engine).rec_info,
+            1,
+        )
+    yield f"nway/{name}", lambda: BlendImages(images).rec_info, 1
+    yield (
+        f"compose/{name}",
+        lambda: gen_recolour_sprite(blended.recolour_dict1, blended.recolour_dict2),
+        100,
+    )
+    yield f"format/{name}", lambda: format_recolour_data(recs), 10
+    yield (
+        f"encode/{name}",
+        lambda: write_image(output, blended.spritemap, images[0].palette),
+        1,
+    )
+
+
+def end_to_end_benchmarks(directory: str, size: int, variants: int):
+    paths = generate_images(directory, size, variants=variants)
+    output = os.path.join(directory, "bench_output.png")
+    recolour = os.path.join(directory, "bench_recolour.txt")
+
+    def run(nway):
+        spritemap, palette, recs = process_image(paths, nway=nway)
+        write_image(output, spritemap, palette)
+        write_recolour(recolour, recs)
+
+    name = f"{size}x{size}/{variants}"
+    yield f"end_to_end/pairwise/{name}", lambda: run(False), 1
+    yield f"end_to_end/nway/{name}", lambda: run(True), 1
+
+
+def run_benchmarks(
+    sizes=SIZES, variants=VARIANTS, repeat: int = 3, only: str = None
+) -> dict:
+    results = {}
+    for module in STARTUP_MODULES:
+        name = f"startup/import/{module}"
+        if only is not None and only not in name:
+            continue
+        results[name] = import_seconds(module, repeat)
+        Print.info(f"{name:<40} {results[name] * 1000:10.3f} ms")
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks = [startup_benchmarks()]
+        for size in sizes:
+            benchmarks.append(stage_benchmarks(directory, size))
+            for count in variants:
+                benchmarks.append(end_to_end_benchmarks(directory, size, count))
+        for group in benchmarks:
+            for name, function, number in group:
+                if only is not None and only not in name:
+                    continue
+                # the pipeline reports what it does, keep the table readable
+                with redirect_stdout(io.StringIO()):
+                    seconds = measure(function, repeat, number)
+                results[name] = seconds
+                Print.info(f"{name:<40} {seconds * 1000:10.3f} ms")
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        change = seconds / baseline[name] - 1 if baseline[name] else 0.0
+        line = f"{name:<40} {baseline[name] * 1000:10.3f} ms -> {seconds * 1000:10.3f} ms ({change:+.0%})"
+        if change > tolerance:
+            regressions.append(name)
+            line = Print.colour(line, "red")
+        Print.info(line)
+    return regressions
+
+
+def run(
+    *,
+    quick: bool = False,
+    repeat: int = 3,
+    only: str = None,
+    save: str = None,
+    baseline: str = None,
+    tolerance: float = 0.2,
+) -> None:
+    # exits with 1 when a benchmark is slower than `baseline` by more than
+    # `tolerance`
+    sizes = SIZES[:2] if quick else SIZES
+    variants = VARIANTS[:2] if quick else VARIANTS
+    results = run_benchmarks(sizes, variants, repeat, only)
+
+    if save is not None:
+        with open(save, "w+") as f:
+            json.dump(results, f, indent=4)
+        Print.info(f"Results written to {save}")
+
+    if baseline is not None:
+        try:
+            with open(baseline, "r") as f:
+                baseline = json.load(f)
+        except Exception as e:
+            Print.error(f"failed to load baseline, {type(e).__name__}, {e}")
+        Print.info("")
+        regressions = compare(results, baseline, tolerance)
+        if regressions:
+            Print.error(
+                f"{len(regressions)} benchmarks regressed by more than {tolerance:.0%}"
+            )
+
+
+def main():
+    from blend_cli import script
+
+    script("bench")
+
+
+if __name__ == "__main__":
+    main()
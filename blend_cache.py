@@ -0,0 +1,294 @@
+from blend import ENGINE_VERSION, Print, RecolourTable, Spritemap, process_image
+import hashlib
+import json
+import mmap
+import numpy as np
+import os
+import re
+import tempfile
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# the names ResultCache writes, the key of a result
+RESULT_NAME = re.compile(r"[0-9a-f]{40}\.npz")
+# the names DecodeCache writes, a content or stat hash and what it holds
+PLANE_NAME = re.compile(r"[0-9a-f]{40}\.(plane|json)")
+REF_NAME = re.compile(r"[0-9a-f]{40}")
+
+
+class ResultCache:
+    # blend results stored on disk under a hash of the input files, so an
+    # unchanged set is answered without decoding or blending anything
+    def __init__(self, path: str, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(
+        self, image_paths: list[str], reserved: frozenset = frozenset(), kind: str = ""
+    ) -> str:
+        # the png bytes cover both pixels and palette, hashing them in order
+        # also covers the input order. `kind` keeps entries other than blend
+        # results apart
+        digest = hashlib.blake2b(
+            f"engine {ENGINE_VERSION}{kind}".encode(), digest_size=20
+        )
+        if reserved:
+            digest.update(f"reserved {sorted(reserved)}".encode())
+        for image_path in image_paths:
+            try:
+                with open(image_path, "rb") as f:
+                    digest.update(hashlib.blake2b(f.read()).digest())
+            except OSError as e:
+                Print.error(f"failed to load image, {type(e).__name__}, {e}")
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.npz")
+
+    def load(self, key: str, image_paths: list[str]):
+        entry = self._entry(key)
+        try:
+            with np.load(entry) as data:
+                spritemap = data["spritemap"]
+                palette = data["palette"].tolist()
+                tables = data["tables"]
+            # touching the entry is what keeps it at the front of the LRU
+            os.utime(entry)
+        except (OSError, KeyError, ValueError):
+            return None
+        height, width = spritemap.shape
+        recolour_sprites = {
+            image_path: RecolourTable(table)
+            for image_path, table in zip(image_paths, tables)
+        }
+        return (Spritemap(spritemap.ravel(), width, height), palette, recolour_sprites)
+
+    def store(self, key: str, image_paths: list[str], result: tuple) -> None:
+        spritemap, palette, recolour_sprites = result
+        tables = [
+            RecolourTable.of(recolour_sprites[image_path]).array()
+            for image_path in image_paths
+        ]
+        # write next to the entry and rename, other workers may read it meanwhile
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(
+                f,
+                spritemap=spritemap.array(),
+                palette=np.array(palette, dtype=np.uint8),
+                tables=np.array(tables, dtype=np.uint8),
+            )
+        os.replace(temp, self._entry(key))
+        self.evict()
+
+    def entries(self) -> list[os.DirEntry]:
+        return [
+            entry
+            for entry in os.scandir(self.path)
+            if entry.is_file() and RESULT_NAME.fullmatch(entry.name)
+        ]
+
+    def evict(self) -> None:
+        entries = []
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                # another worker evicted it first
+                pass
+            total -= size
+
+    def optimize_order(
+        self,
+        image_paths: list[str],
+        seconds: float,
+        decode_cache=None,
+        reserved: frozenset = frozenset(),
+    ) -> tuple:
+        # blend_order.optimize_order, but an order found for the same inputs
+        # before is reused without decoding them, so the blend in that order
+        # can be a hit too. The images are None then
+        entry = self._entry(self.key(image_paths, reserved, " order"))
+        try:
+            with np.load(entry) as data:
+                order = data["order"].tolist()
+            os.utime(entry)
+            if len(order) == len(image_paths):
+                Print.info("Input order      : as found before")
+                return ([image_paths[i] for i in order], None)
+        except (OSError, KeyError, ValueError, IndexError):
+            pass
+        from blend_order import optimize_order
+
+        ordered, images = optimize_order(image_paths, seconds, decode_cache, reserved)
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, order=np.array([image_paths.index(p) for p in ordered]))
+        os.replace(temp, entry)
+        self.evict()
+        return (ordered, images)
+
+    def process_image(
+        self,
+        image_paths: list[str],
+        engine: str = "pairkey",
+        nway: bool = False,
+        decode_cache=None,
+        reserved: frozenset = frozenset(),
+        images: list = None,
+    ) -> tuple:
+        key = self.key(image_paths, reserved)
+        result = self.load(key, image_paths)
+        if result is not None:
+            self.hits += 1
+            Print.info(f"Cache hit        : {key}")
+            return result
+        self.misses += 1
+        result = process_image(
+            image_paths, engine, nway, decode_cache, reserved, images
+        )
+        self.store(key, image_paths, result)
+        return result
+
+    def report(self) -> None:
+        Print.info(
+            f"Cache: {self.hits} hits, {self.misses} misses, {self.evictions} evicted"
+        )
+
+
+class DecodeCache:
+    # decoded index planes kept as raw files that are mapped straight back
+    # into a Spritemap. Planes are named by content hash, refs/ maps a
+    # path, mtime and size to the content hash so unchanged files are not
+    # even read again
+    def __init__(self, path: str):
+        self.path = path
+        self.refs = os.path.join(path, "refs")
+
+    @staticmethod
+    def _stat_key(image_path: str) -> str:
+        stat = os.stat(image_path)
+        ident = f"{os.path.abspath(image_path)}\0{stat.st_mtime_ns}\0{stat.st_size}"
+        return hashlib.blake2b(ident.encode(), digest_size=20).hexdigest()
+
+    @staticmethod
+    def _content_key(image_path: str) -> str:
+        with open(image_path, "rb") as f:
+            return hashlib.blake2b(f.read(), digest_size=20).hexdigest()
+
+    def _write(self, filename: str, data: bytes) -> None:
+        # the directories only appear once something is cached, --info or
+        # --clear on a wrong path mustn't leave a refs/ behind
+        os.makedirs(self.refs, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp, filename)
+
+    def _read_ref(self, stat_key: str):
+        try:
+            with open(os.path.join(self.refs, stat_key), "r") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _map(self, content_key: str):
+        try:
+            with open(os.path.join(self.path, f"{content_key}.json"), "r") as f:
+                meta = json.load(f)
+            with open(os.path.join(self.path, f"{content_key}.plane"), "rb") as f:
+                if meta["width"] * meta["height"] == 0:
+                    data = b""
+                else:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, KeyError, ValueError):
+            return None
+        if len(data) != meta["width"] * meta["height"]:
+            return None
+        return (Spritemap(data, meta["width"], meta["height"]), meta["palette"])
+
+    def load(self, image_path: str):
+        try:
+            stat_key = self._stat_key(image_path)
+        except OSError:
+            # let the normal decode path report the missing file
+            return None
+        content_key = self._read_ref(stat_key)
+        if content_key is not None:
+            cached = self._map(content_key)
+            if cached is not None:
+                return cached
+        # the file was touched or copied, its content may still be known
+        content_key = self._content_key(image_path)
+        cached = self._map(content_key)
+        if cached is not None:
+            self._write(os.path.join(self.refs, stat_key), content_key.encode())
+        return cached
+
+    def store(self, image_path: str, spritemap: Spritemap, palette: list) -> None:
+        stat_key = self._stat_key(image_path)
+        content_key = self._content_key(image_path)
+        meta = {
+            "width": spritemap.width,
+            "height": spritemap.height,
+            "palette": palette,
+        }
+        self._write(os.path.join(self.path, f"{content_key}.plane"), spritemap.data)
+        self._write(
+            os.path.join(self.path, f"{content_key}.json"), json.dumps(meta).encode()
+        )
+        self._write(os.path.join(self.refs, stat_key), content_key.encode())
+
+    def entries(self) -> list[os.DirEntry]:
+        # only the files the cache wrote itself, the directory may well be one
+        # the user keeps other things in
+        entries = []
+        for directory, pattern in ((self.path, PLANE_NAME), (self.refs, REF_NAME)):
+            try:
+                entries += [
+                    entry
+                    for entry in os.scandir(directory)
+                    if entry.is_file() and pattern.fullmatch(entry.name)
+                ]
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def size(self) -> tuple[int, int]:
+        # (number of cached planes, bytes used on disk)
+        planes = 0
+        total = 0
+        for entry in self.entries():
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                continue
+            planes += entry.name.endswith(".plane")
+        return (planes, total)
+
+    def clear(self) -> None:
+        for entry in self.entries():
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def report(self) -> None:
+        planes, total = self.size()
+        Print.info(
+            f"Decode cache: {planes} images, {total / 1024 / 1024:.2f} MB in {self.path}"
+        )
@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+# one entry point for the blend tools. Only argparse is imported up front and
+# every subcommand imports what it needs when it runs, so compose never loads
+# PIL or numpy and --help answers at once
+import argparse
+
+
+def _megabytes(text: str) -> int:
+    try:
+        return int(float(text) * 1024 * 1024)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size in MB: {text}")
+
+
+def _positive(text: str) -> int:
+    try:
+        number = int(text)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a number above 0: {text}")
+    return number
+
+
+def _count(text: str) -> int:
+    try:
+        number = int(text)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"expected 0 or more: {text}")
+    return number
+
+
+def _reserve(text: str) -> frozenset:
+    from blend import PaletteSlots
+
+    try:
+        return PaletteSlots.parse_reserve(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _box(text: str) -> list:
+    try:
+        box = tuple(int(value) for value in text.split(","))
+    except ValueError:
+        box = ()
+    if len(box) != 4:
+        raise argparse.ArgumentTypeError(f"expected LEFT,TOP,RIGHT,BOTTOM: {text}")
+    return [box]
+
+
+def _regions(text: str) -> list:
+    import json
+
+    try:
+        with open(text, "r") as f:
+            return [tuple(map(int, region)) for region in json.load(f)]
+    except Exception as e:
+        raise argparse.ArgumentTypeError(
+            f"failed to load regions, {type(e).__name__}, {e}"
+        )
+
+
+def _reserved(options) -> frozenset:
+    return frozenset().union(*options.reserve)
+
+
+def blend(options) -> None:
+    import blend
+
+    blend.run(
+        options.images,
+        output=options.output,
+        recolour=options.recolour,
+        engine=options.engine,
+        nway=options.nway,
+        cache_dir=options.cache,
+        cache_size=options.cache_size,
+        decode_cache_dir=options.decode_cache,
+        decode_cache_clear=options.clear,
+        decode_cache_info=options.info,
+        memory_budget=options.memory_budget,
+        profile=options.profile,
+        dry_run=options.dry_run,
+        reserved=_reserved(options),
+        optimize_seconds=options.optimize_order,
+        verify=options.verify,
+        compress_level=options.compress_level,
+        optimize_png=options.optimize_png,
+        trim_palette=options.trim_palette,
+    )
+
+
+def compose(options) -> None:
+    import blend_compose
+
+    blend_compose.run(options.sources, spec=options.spec, output=options.output)
+
+
+def regions(options) -> None:
+    import blend_regions
+
+    blend_regions.run(
+        options.images,
+        # --regions and --box in the order given
+        regions=[box for boxes in options.regions for box in boxes] or None,
+        workers=options.workers,
+        cache_dir=options.cache,
+        reserved=_reserved(options),
+    )
+
+
+def partition(options) -> None:
+    import blend_partition
+
+    blend_partition.run(
+        options.images,
+        engine=options.engine,
+        workers=options.workers,
+        decode_cache=options.decode_cache,
+        reserved=_reserved(options),
+        dry_run=options.dry_run,
+    )
+
+
+def watch(options) -> None:
+    import blend_watch
+
+    blend_watch.run(
+        options.inputs,
+        interval=options.interval,
+        engine=options.engine,
+        reserved=_reserved(options),
+        verify=options.verify,
+    )
+
+
+def serve(options) -> None:
+    import blend_server
+
+    blend_server.run(
+        address=options.address,
+        workers=options.workers,
+        max_pending=options.max_pending,
+        root=options.root,
+    )
+
+
+def bench(options) -> None:
+    import blend_bench
+
+    blend_bench.run(
+        quick=options.quick,
+        repeat=options.repeat,
+        only=options.only,
+        save=options.save,
+        baseline=options.compare,
+        tolerance=options.tolerance,
+    )
+
+
+def verify(options) -> None:
+    # checks an earlier blend on disk: every input must come back from the
+    # output through the recolour sprite named after it
+    from blend import Print, ProcessImage, check_round_trip
+    from blend_compose import load_recolour_sprites
+
+    tables, _ = load_recolour_sprites([options.recolour])
+    missing = [image for image in options.images if image not in tables]
+    if missing:
+        Print.error(
+            f"{options.recolour} has no recolour sprite for {', '.join(missing)}"
+        )
+    decode_cache = None
+    if options.decode_cache is not None:
+        from blend_cache import DecodeCache
+
+        decode_cache = DecodeCache(options.decode_cache)
+    check_round_trip(
+        options.images,
+        ProcessImage(options.output).spritemap,
+        {image: tables[image] for image in options.images},
+        decode_cache,
+    )
+
+
+def batch(options) -> None:
+    import blend_batch
+
+    blend_batch.run(
+        options.manifest,
+        workers=options.workers,
+        cache_dir=options.cache,
+        cache_size=options.cache_size,
+        decode_cache=options.decode_cache,
+        profile=options.profile,
+        dry_run=options.dry_run,
+        reserved=_reserved(options),
+        recolour_index=options.recolour_index,
+        verify=options.verify,
+        png={
+            "compress_level": options.compress_level,
+            "optimize": options.optimize_png,
+            "trim_palette": options.trim_palette,
+        },
+        encoders=options.encoders,
+        prefetch=options.prefetch,
+    )
+
+
+def add_reserve(command) -> None:
+    command.add_argument(
+        "--reserve",
+        type=_reserve,
+        action="append",
+        default=[],
+        metavar="INDICES",
+        help="palette indices to keep free, e.g. 0,198-205 or company",
+    )
+
+
+def add_png(command) -> None:
+    command.add_argument(
+        "--compress-level",
+        type=int,
+        choices=range(10),
+        metavar="0-9",
+        help="PNG compression, 0 is fastest and 9 smallest",
+    )
+    command.add_argument(
+        "--optimize-png",
+        action="store_true",
+        help="spend more time on a smaller PNG",
+    )
+    command.add_argument(
+        "--trim-palette",
+        action="store_true",
+        help="drop palette entries past the highest index used",
+    )
+
+
+def add_profile(command) -> None:
+    command.add_argument(
+        "--profile", metavar="MODES", help="time, memory and/or cprofile"
+    )
+
+
+def add_verify_arguments(command) -> None:
+    command.add_argument("images", nargs="+")
+    command.add_argument("-o", "--output", default="output.png")
+    command.add_argument("-r", "--recolour", default="recolour.txt")
+    command.add_argument("--decode-cache", metavar="DIR")
+
+
+def add_blend_arguments(command) -> None:
+    command.add_argument(
+        "images", nargs="*", help="none needed for --clear or --info alone"
+    )
+    command.add_argument("-o", "--output", default="output.png")
+    command.add_argument("-r", "--recolour", default="recolour.txt")
+    command.add_argument("--engine", default="pairkey")
+    command.add_argument("--nway", action="store_true")
+    command.add_argument("--cache", metavar="DIR", help="result cache directory")
+    command.add_argument("--cache-size", type=_megabytes, metavar="MB")
+    command.add_argument("--decode-cache", metavar="DIR")
+    command.add_argument(
+        "--clear", action="store_true", help="clear the decode cache first"
+    )
+    command.add_argument(
+        "--info", action="store_true", help="report the decode cache first"
+    )
+    command.add_argument("--memory-budget", type=_megabytes, metavar="MB")
+    add_profile(command)
+    command.add_argument(
+        "--dry-run", action="store_true", help="only predict the colours needed"
+    )
+    add_reserve(command)
+    command.add_argument("--optimize-order", type=float, metavar="SECONDS")
+    command.add_argument(
+        "--verify", action="store_true", help="check every input round-trips"
+    )
+    add_png(command)
+
+
+def add_batch_arguments(command) -> None:
+    command.add_argument("manifest", help="JSON or TOML manifest")
+    command.add_argument("--workers", type=_positive, metavar="N")
+    command.add_argument("--cache", metavar="DIR", help="result cache directory")
+    command.add_argument("--cache-size", type=_megabytes, metavar="MB")
+    command.add_argument("--decode-cache", metavar="DIR")
+    add_profile(command)
+    command.add_argument(
+        "--dry-run", action="store_true", help="only predict the colours needed"
+    )
+    add_reserve(command)
+    command.add_argument("--recolour-index", metavar="FILE")
+    command.add_argument(
+        "--verify", action="store_true", help="check every input round-trips"
+    )
+    add_png(command)
+    command.add_argument(
+        "--encoders",
+        type=_count,
+        metavar="N",
+        help="threads writing PNGs while the workers blend, 0 to write in the workers",
+    )
+    command.add_argument(
+        "--prefetch",
+        type=_count,
+        metavar="N",
+        help="jobs past the running ones whose inputs are read ahead, 0 for none",
+    )
+
+
+def add_compose_arguments(command) -> None:
+    command.add_argument("sources", nargs="*", help="NML files, - for stdin")
+    command.add_argument(
+        "--spec",
+        metavar="FILE",
+        help="JSON or TOML chains, without it every sprite read is one chain",
+    )
+    command.add_argument("-o", "--output", default="new_recolour.txt")
+
+
+def add_regions_arguments(command) -> None:
+    command.add_argument("images", nargs="+")
+    command.add_argument(
+        "--regions",
+        type=_regions,
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="JSON list of [left, top, right, bottom]",
+    )
+    command.add_argument(
+        "--box",
+        type=_box,
+        action="append",
+        dest="regions",
+        metavar="LEFT,TOP,RIGHT,BOTTOM",
+    )
+    command.add_argument("--workers", type=_positive, metavar="N")
+    command.add_argument("--cache", metavar="DIR", help="result cache directory")
+    add_reserve(command)
+
+
+def add_partition_arguments(command) -> None:
+    command.add_argument("images", nargs="+")
+    command.add_argument("--engine", default="pairkey")
+    command.add_argument("--workers", type=_positive, metavar="N")
+    command.add_argument("--decode-cache", metavar="DIR")
+    add_reserve(command)
+    command.add_argument("--dry-run", action="store_true", help="only print the groups")
+
+
+def add_watch_arguments(command) -> None:
+    command.add_argument(
+        "inputs", nargs="+", help="images to blend, or one batch manifest"
+    )
+    command.add_argument("--interval", type=float, default=0.1, metavar="SECONDS")
+    command.add_argument("--engine", default="pairkey")
+    add_reserve(command)
+    command.add_argument(
+        "--verify", action="store_true", help="check every input round-trips"
+    )
+
+
+def add_server_arguments(command) -> None:
+    command.add_argument(
+        "--address",
+        metavar="HOST:PORT",
+        help="127.0.0.1:8765 unless BLEND_SERVER is set",
+    )
+    command.add_argument("--workers", type=_positive, metavar="N")
+    command.add_argument("--max-pending", type=_positive, metavar="N")
+    command.add_argument(
+        "--root",
+        default=".",
+        metavar="DIR",
+        help="only blend for clients in this directory or below it",
+    )
+
+
+def add_bench_arguments(command) -> None:
+    command.add_argument(
+        "--quick", action="store_true", help="only the two smallest sizes and sets"
+    )
+    command.add_argument("--repeat", type=_positive, default=3, metavar="N")
+    command.add_argument("--only", metavar="NAME", help="benchmarks containing NAME")
+    command.add_argument("--save", metavar="FILE")
+    command.add_argument("--compare", metavar="FILE")
+    command.add_argument("--tolerance", type=float, default=0.2)
+
+
+# every subcommand: the script that takes the same options (the scripts parse
+# their arguments with script_parser), what it does, its options and its run
+COMMANDS = {
+    "blend": (
+        "blend.py",
+        "blend images into one image plus recolour sprites",
+        add_blend_arguments,
+        blend,
+    ),
+    "compose": (
+        "blend_compose.py",
+        "compose recolour sprites",
+        add_compose_arguments,
+        compose,
+    ),
+    "verify": (
+        None,
+        "check that a blend on disk gives back its inputs",
+        add_verify_arguments,
+        verify,
+    ),
+    "batch": ("blend_batch.py", "run a manifest of blends", add_batch_arguments, batch),
+    "regions": (
+        "blend_regions.py",
+        "blend every sprite of a sheet on its own",
+        add_regions_arguments,
+        regions,
+    ),
+    "partition": (
+        "blend_partition.py",
+        "blend a set that needs too many colours in groups",
+        add_partition_arguments,
+        partition,
+    ),
+    "watch": (
+        "blend_watch.py",
+        "re-blend whenever an input changes",
+        add_watch_arguments,
+        watch,
+    ),
+    "serve": (
+        "blend_server.py",
+        "serve blends to blend_client.py from warm workers",
+        add_server_arguments,
+        serve,
+    ),
+    "bench": (
+        "blend_bench.py",
+        "benchmark the pipeline on generated sprites",
+        add_bench_arguments,
+        bench,
+    ),
+}
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="blend_cli.py",
+        description="Blend indexed images into one image plus recolour sprites",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, (script, text, add_arguments, run) in COMMANDS.items():
+        command = commands.add_parser(
+            name, help=text if script is None else f"{text}, like {script}"
+        )
+        add_arguments(command)
+        command.set_defaults(run=run)
+    return parser
+
+
+def script_parser(name: str) -> argparse.ArgumentParser:
+    # the parser of a script, the same options as its subcommand
+    script, text, add_arguments, run = COMMANDS[name]
+    parser = argparse.ArgumentParser(
+        prog=script, description=text[0].upper() + text[1:]
+    )
+    add_arguments(parser)
+    parser.set_defaults(run=run)
+    return parser
+
+
+def start(options) -> None:
+    from blend_core import copyright
+
+    copyright()
+    options.run(options)
+
+
+def script(name: str) -> None:
+    # the main() of every script
+    start(script_parser(name).parse_args())
+
+
+def main():
+    start(parser().parse_args())
+
+
+if __name__ == "__main__":
+    main()
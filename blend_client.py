@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# takes the same arguments as blend.py and has blend_server.py do the work, so
+# a build pays for a small request instead of starting Python with PIL and
+# numpy for every blend. Only the standard library is imported up front
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+# seconds without an answer before the client gives up on the server, a stuck
+# server mustn't hang the build. The build then fails, the server may still
+# finish the blend
+TIMEOUT = 120
+
+
+def request(address: str, path: str, body: dict = None, timeout=TIMEOUT) -> dict:
+    data = None if body is None else json.dumps(body).encode()
+    with urllib.request.urlopen(
+        urllib.request.Request(
+            f"http://{address}{path}",
+            data=data,
+            headers={"Content-Type": "application/json"},
+        ),
+        timeout=timeout,
+    ) as response:
+        return json.loads(response.read())
+
+
+def blend_locally(reason: str) -> None:
+    # without a server the build still works, just at blend.py's speed
+    import blend
+
+    blend.Print.warn(f"blend server {reason}, blending locally")
+    blend.main()
+
+
+def main():
+    address = os.environ.get("BLEND_SERVER", DEFAULT_ADDRESS)
+    if sys.argv[1:] == ["--status"]:
+        try:
+            status = request(address, "/status")
+        except (urllib.error.URLError, OSError) as e:
+            sys.stderr.write(f"Error: blend server at {address} unreachable, {e}\n")
+            sys.exit(1)
+        sys.stdout.write(json.dumps(status, indent=2) + "\n")
+        return
+
+    try:
+        result = request(address, "/blend", {"argv": sys.argv[1:], "cwd": os.getcwd()})
+    except urllib.error.HTTPError as e:
+        if e.code == 503:
+            blend_locally(f"at {address} is busy")
+            return
+        sys.stderr.write(f"Error: blend server at {address} failed, {e}\n")
+        sys.exit(1)
+    except (urllib.error.URLError, OSError) as e:
+        # only a server that never took the request may be blended around. One
+        # that timed out may still be writing the outputs, a second writer
+        # would race it
+        reason = getattr(e, "reason", e)
+        if isinstance(reason, ConnectionRefusedError):
+            blend_locally(f"at {address} unreachable")
+            return
+        if isinstance(reason, TimeoutError):
+            sys.stderr.write(
+                f"Error: blend server at {address} didn't answer within"
+                f" {TIMEOUT} seconds, the blend may still be running there\n"
+            )
+        else:
+            sys.stderr.write(f"Error: blend server at {address} failed, {e}\n")
+        sys.exit(1)
+    sys.stdout.write(result["stdout"])
+    sys.stderr.write(result["stderr"])
+    sys.exit(result["code"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+from blend_core import Print, RecolourTable, profiler, write_recolour_files
+import json
+import re
+import sys
+
+# one pass over every line: whole "a..b: c..d;" entries are a single token so
+# a block of 256 entries costs 256 matches, not a thousand
+TOKEN = re.compile(
+    r"""
+    (?P<space>\s+)
+    |(?P<comment>//[^\n]*)
+    |(?P<open_comment>/\*)
+    |(?P<entry>(?P<key>0[xX][0-9a-fA-F]+|\d+)(?:\s*\.\.\s*(?P<key_end>0[xX][0-9a-fA-F]+|\d+))?
+        \s*:\s*(?P<value>0[xX][0-9a-fA-F]+|\d+)(?:\s*\.\.\s*(?P<value_end>0[xX][0-9a-fA-F]+|\d+))?
+        \s*;)
+    |(?P<string>"(?:\\.|[^"\\])*")
+    |(?P<word>[A-Za-z_]\w*)
+    |(?P<other>.)
+    """,
+    re.VERBOSE,
+)
+# inside a block most lines are nothing but plain "a: b;" entries, those are
+# taken a whole run at a time
+ENTRY_RUN = re.compile(
+    r"(?:\s*(?:0[xX][0-9a-fA-F]+|\d+)\s*:\s*(?:0[xX][0-9a-fA-F]+|\d+)\s*;)+"
+)
+ENTRY_PAIR = re.compile(r"(0[xX][0-9a-fA-F]+|\d+)\s*:\s*(0[xX][0-9a-fA-F]+|\d+)")
+# the usual spellings of every index, anything else goes through _number
+NUMBERS = {
+    form: i
+    for i in range(256)
+    for form in (
+        str(i),
+        f"0x{i:x}",
+        f"0x{i:02x}",
+        f"0x{i:X}",
+        f"0x{i:02X}",
+        f"0X{i:x}",
+        f"0X{i:02x}",
+        f"0X{i:X}",
+        f"0X{i:02X}",
+    )
+}
+
+
+class RecolourParseError(ValueError):
+    pass
+
+
+def _number(text: str) -> int:
+    if text in NUMBERS:
+        return NUMBERS[text]
+    return int(text, 16) if text[:2] in ("0x", "0X") else int(text)
+
+
+def _set_entries(data: bytearray, match: re.Match) -> None:
+    key = _number(match["key"])
+    key_end = _number(match["key_end"]) if match["key_end"] else key
+    value = _number(match["value"])
+    value_end = _number(match["value_end"]) if match["value_end"] else value
+    if not (0 <= key <= key_end < 256 and 0 <= value < 256 and 0 <= value_end < 256):
+        raise RecolourParseError(f"entry '{match['entry']}' is out of range")
+    count = key_end - key + 1
+    if value == value_end:
+        data[key : key_end + 1] = bytes([value]) * count
+    elif value_end - value + 1 == count:
+        data[key : key_end + 1] = bytes(range(value, value_end + 1))
+    else:
+        raise RecolourParseError(
+            f"entry '{match['entry']}' maps {count} indices to {abs(value_end - value) + 1} colours"
+        )
+
+
+def read_recolour_sprites(lines, source: str = "<stdin>"):
+    # yields (name, "source:index", table bytes) for every recolour_sprite
+    # block in the stream. A block is named by the first comment inside it,
+    # as written by blend.py, otherwise by "source:index"; every other NML
+    # construct is skipped
+    index = 0
+    state = "outside"  # outside, header (after the keyword) or block
+    in_comment = False
+    name = None
+    data = None
+    for number, line in enumerate(lines, 1):
+        position = 0
+        while position < len(line):
+            if in_comment:
+                end = line.find("*/", position)
+                if end == -1:
+                    break
+                in_comment = False
+                position = end + 2
+                continue
+            if state == "block":
+                run = ENTRY_RUN.match(line, position)
+                if run is not None:
+                    try:
+                        for key, value in ENTRY_PAIR.findall(line, position, run.end()):
+                            data[NUMBERS[key]] = NUMBERS[value]
+                    except KeyError:
+                        # an unusual or out of range number, let the tokenizer
+                        # take this run entry by entry
+                        pass
+                    else:
+                        position = run.end()
+                        continue
+            match = TOKEN.match(line, position)
+            position = match.end()
+            kind = match.lastgroup
+            if kind == "space":
+                continue
+            if kind == "open_comment":
+                in_comment = True
+                continue
+            if state == "outside":
+                if kind == "word" and match[0] == "recolour_sprite":
+                    state = "header"
+            elif state == "header":
+                if kind == "comment":
+                    continue
+                if match[0] != "{":
+                    raise RecolourParseError(
+                        f"{source}:{number}: expected '{{' after recolour_sprite"
+                    )
+                state = "block"
+                name = None
+                data = bytearray(RecolourTable.identity)
+            elif kind == "entry":
+                try:
+                    _set_entries(data, match)
+                except RecolourParseError as e:
+                    raise RecolourParseError(f"{source}:{number}: {e}")
+            elif kind == "comment":
+                if name is None:
+                    name = match[0][2:].strip()
+            elif match[0] == "}":
+                yield (name or f"{source}:{index}", f"{source}:{index}", data)
+                index += 1
+                state = "outside"
+            else:
+                raise RecolourParseError(
+                    f"{source}:{number}: unexpected '{match[0]}' in recolour_sprite"
+                )
+    if state != "outside":
+        raise RecolourParseError(f"{source}: unterminated recolour_sprite")
+
+
+def load_recolour_sprites(paths: list[str]) -> tuple[dict, list]:
+    # every block by name and by "source:index", plus the blocks in order
+    tables = {}
+    ordered = []
+    shared = 0
+    for path in paths:
+        try:
+            f = sys.stdin if path == "-" else open(path, "r", buffering=1 << 16)
+            with f:
+                source = "<stdin>" if path == "-" else path
+                for name, position, data in read_recolour_sprites(f, source):
+                    table = RecolourTable(data)
+                    if name in tables:
+                        shared += 1
+                    else:
+                        tables[name] = table
+                    tables[position] = table
+                    ordered.append(table)
+        except OSError as e:
+            Print.error(f"failed to load recolour sprites, {type(e).__name__}, {e}")
+        except RecolourParseError as e:
+            Print.error(e)
+    if shared:
+        Print.warn(
+            f"{shared} recolour sprites share a name with an earlier one,"
+            " refer to them as file:index"
+        )
+    return (tables, ordered)
+
+
+def load_spec(path: str) -> list[tuple[str, list[str]]]:
+    # {"chains": [["a", "b", "c"], {"name": "x", "sprites": ["a", "b"]}, ...]}
+    try:
+        if path.endswith(".toml"):
+            import tomllib
+
+            with open(path, "rb") as f:
+                spec = tomllib.load(f)
+        else:
+            with open(path, "r") as f:
+                spec = json.load(f)
+    except Exception as e:
+        Print.error(f"failed to load spec, {type(e).__name__}, {e}")
+
+    chains = []
+    for i, chain in enumerate(spec.get("chains", [])):
+        if isinstance(chain, dict):
+            if "sprites" not in chain:
+                Print.error(f"chain {i} in {path} is missing 'sprites'")
+            sprites = list(chain["sprites"])
+            name = chain.get("name", " + ".join(sprites))
+        else:
+            sprites = list(chain)
+            name = " + ".join(sprites)
+        if len(sprites) < 1:
+            Print.error(f"chain {i} in {path} is empty")
+        chains.append((name, sprites))
+    return chains
+
+
+def compose_chains(tables: dict, chains: list[tuple[str, list[str]]]) -> dict:
+    # a chain "a, b, c" is a after b after c, the same order as
+    # blend_recolour_sprites.py composes its two sprites in
+    results = {}
+    with profiler.stage("compose"):
+        for name, sprites in chains:
+            try:
+                composed = tables[sprites[0]]
+                for sprite in sprites[1:]:
+                    composed = composed.compose(tables[sprite])
+            except KeyError as e:
+                Print.error(f"chain '{name}' refers to unknown recolour sprite {e}")
+            results[name] = composed
+    return results
+
+
+def run(sources: list[str], *, spec: str = None, output: str = "new_recolour.txt"):
+    # composes every chain of `spec`, or all sprites read in one chain
+    import time
+
+    start = time.time()
+
+    tables, ordered = load_recolour_sprites(sources or ["-"])
+    Print.info(f"Recolour sprites : {len(ordered)}")
+    if spec is not None:
+        chains = load_spec(spec)
+        results = compose_chains(tables, chains)
+    else:
+        if not ordered:
+            Print.error("No recolour sprites found")
+        composed = ordered[0]
+        for table in ordered[1:]:
+            composed = composed.compose(table)
+        results = {output: composed}
+    Print.info(f"Composed         : {len(results)}")
+    write_recolour_files({output: [results]})
+
+    Print.info(f"Time taken: {time.time() - start:.2f}s")
+
+
+def main():
+    from blend_cli import script
+
+    script("compose")
+
+
+if __name__ == "__main__":
+    main()
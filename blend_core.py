@@ -0,0 +1,375 @@
+# the parts of blend.py that work on recolour tables alone. Nothing here
+# imports PIL, and numpy only once a table meets a spritemap, so tools that
+# only read, compose and write recolour sprites start quickly
+from collections.abc import Mapping
+from contextlib import contextmanager
+import io
+import json
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# bump whenever a change alters blend output, cached results depend on it
+ENGINE_VERSION = 1
+
+
+class Print:
+    colours = {"red": "\033[91m", "yellow": "\033[93m", "reset": "\033[0m"}
+
+    @staticmethod
+    def error(*message, sep=" "):
+        sys.stderr.write(
+            f"{Print.colours['red']}Error: {sep.join(map(str, message))}{Print.colours['reset']}\n"
+        )
+        sys.exit(1)
+
+    @staticmethod
+    def warn(*message, sep=" "):
+        sys.stderr.write(
+            f"{Print.colours['yellow']}Warning: {sep.join(map(str, message))}{Print.colours['reset']}\n"
+        )
+
+    @staticmethod
+    def info(*message, sep=" "):
+        sys.stdout.write(f"{sep.join(map(str, message))}\n")
+
+    @staticmethod
+    # does not print anything but colours the message
+    def colour(message, colour):
+        return f"{Print.colours[colour]}{message}{Print.colours['reset']}"
+
+
+class Profiler:
+    # named stage timers around the pipeline, no-ops until start() is called.
+    # Stages may nest (spritemaps load lazily inside a blend), so both the
+    # inclusive time and the time spent in the stage itself are kept. Every
+    # thread nests its own stages, images decoding on loader threads add
+    # their time to the same totals. Memory peaks are process-wide, with
+    # "memory" the loader decodes on the calling thread so each peak belongs
+    # to one stage
+    modes = ("time", "memory", "cprofile")
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.stages = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profile = None
+        self._start = None
+
+    @property
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self, modes=("time",)) -> None:
+        for mode in modes:
+            if mode not in self.modes:
+                Print.error(
+                    f"Unknown profile mode {mode}, choose from {', '.join(self.modes)}"
+                )
+        self.enabled = True
+        self.memory = "memory" in modes
+        self.stages = {}
+        self._local = threading.local()
+        # a worker profiles many runs, only this one's may be dumped
+        self._profile = None
+        if self.memory:
+            import tracemalloc
+
+            tracemalloc.start()
+        if "cprofile" in modes:
+            import cProfile
+
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._start = time.perf_counter()
+
+    def stop(self) -> None:
+        if not self.enabled:
+            return
+        self.total = time.perf_counter() - self._start
+        if self._profile is not None:
+            self._profile.disable()
+        if self.memory:
+            import tracemalloc
+
+            tracemalloc.stop()
+        self.enabled = False
+
+    def _peak(self) -> int:
+        import tracemalloc
+
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in self._stack:
+            frame["peak"] = max(frame["peak"], peak)
+        return peak
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        frame = {"name": name, "children": 0.0, "peak": 0, "current": 0}
+        if self.memory:
+            import tracemalloc
+
+            # the running peak belongs to the enclosing stages until now
+            self._peak()
+            tracemalloc.reset_peak()
+            frame["current"] = tracemalloc.get_traced_memory()[0]
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if self.memory:
+                self._peak()
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]["children"] += seconds
+            with self._lock:
+                stage = self.stages.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "self_seconds": 0.0}
+                )
+                stage["calls"] += 1
+                stage["seconds"] += seconds
+                stage["self_seconds"] += seconds - frame["children"]
+                if self.memory:
+                    stage["peak_bytes"] = max(
+                        stage.get("peak_bytes", 0), frame["peak"] - frame["current"]
+                    )
+
+    def report(self, job: str = None) -> dict:
+        return {
+            "job": job,
+            "engine_version": ENGINE_VERSION,
+            "total_seconds": getattr(self, "total", None),
+            "stages": self.stages,
+        }
+
+    def write(self, filename: str, job: str = None) -> None:
+        report = self.report(job)
+        if self._profile is not None:
+            report["cprofile"] = f"{filename}.prof"
+            self._profile.dump_stats(report["cprofile"])
+        with open(filename, "w+") as f:
+            json.dump(report, f, indent=4)
+        Print.info(f"Profile written to {filename}")
+
+    @staticmethod
+    def merge(reports: list[dict]) -> dict:
+        # stage totals over many job reports, e.g. a whole batch run
+        stages = {}
+        for report in reports:
+            for name, stage in report["stages"].items():
+                total = stages.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "self_seconds": 0.0}
+                )
+                for key in ("calls", "seconds", "self_seconds"):
+                    total[key] += stage[key]
+                if "peak_bytes" in stage:
+                    total["peak_bytes"] = max(
+                        total.get("peak_bytes", 0), stage["peak_bytes"]
+                    )
+        return stages
+
+    @staticmethod
+    def print_stages(stages: dict) -> None:
+        for name, stage in sorted(
+            stages.items(), key=lambda item: item[1]["self_seconds"], reverse=True
+        ):
+            line = f"  {name:<16} {stage['self_seconds']:8.4f}s self {stage['seconds']:8.4f}s total {stage['calls']:>5} calls"
+            if "peak_bytes" in stage:
+                line += f" {stage['peak_bytes'] / 1024 / 1024:8.2f} MB peak"
+            Print.info(line)
+
+
+profiler = Profiler()
+
+
+class Spritemap:
+    # a width * height index plane kept in one flat buffer, one byte per pixel
+    def __init__(self, data, width: int, height: int):
+        self.data = memoryview(data).cast("B")
+        self.width = width
+        self.height = height
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return (self.width, self.height)
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, row: int) -> memoryview:
+        if not 0 <= row < self.height:
+            raise IndexError("spritemap row out of range")
+        return self.data[row * self.width : (row + 1) * self.width]
+
+    def __iter__(self):
+        return (self[row] for row in range(self.height))
+
+    def array(self) -> "np.ndarray":
+        # a (height, width) view sharing the buffer, no copy
+        import numpy as np
+
+        return np.frombuffer(self.data, dtype=np.uint8).reshape(self.height, self.width)
+
+    def tobytes(self) -> bytes:
+        return self.data.tobytes()
+
+
+class RecolourTable(Mapping):
+    # a recolour map as 256 bytes, index -> colour. It reads like the
+    # dict[int, int] used before, but composing two tables is a single
+    # bytes.translate and applying one to a spritemap a single lookup
+    __slots__ = ("data",)
+    identity = bytes(range(256))
+
+    def __init__(self, data: bytes = identity):
+        self.data = bytes(data)
+        if len(self.data) != 256:
+            raise ValueError("a recolour table has exactly 256 entries")
+
+    @classmethod
+    def of(cls, rec) -> "RecolourTable":
+        # tables pass through, dicts only need to list the changed entries
+        if isinstance(rec, RecolourTable):
+            return rec
+        data = bytearray(cls.identity)
+        for key, value in rec.items():
+            data[key] = value
+        return cls(data)
+
+    def __getitem__(self, key: int) -> int:
+        if not isinstance(key, int) or not 0 <= key < 256:
+            raise KeyError(key)
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(range(256))
+
+    def __len__(self):
+        return 256
+
+    def __eq__(self, other):
+        if isinstance(other, RecolourTable):
+            return self.data == other.data
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __repr__(self):
+        return f"RecolourTable({dict(self.changes())})"
+
+    def copy(self) -> "RecolourTable":
+        # tables are immutable, sharing is safe
+        return self
+
+    def array(self) -> "np.ndarray":
+        import numpy as np
+
+        return np.frombuffer(self.data, dtype=np.uint8)
+
+    def compose(self, other: "RecolourTable") -> "RecolourTable":
+        # self after other: result[k] = self[other[k]]
+        return RecolourTable(other.data.translate(self.data))
+
+    @staticmethod
+    def compose_all(
+        tables: list["RecolourTable"], other: "RecolourTable"
+    ) -> list["RecolourTable"]:
+        # compose every table with the same `other` in one take over the stack
+        if not tables:
+            return []
+        import numpy as np
+
+        stack = np.frombuffer(b"".join(table.data for table in tables), np.uint8)
+        composed = stack.reshape(len(tables), 256)[:, other.array()]
+        return [RecolourTable(row) for row in composed]
+
+    def apply(self, spritemap: Spritemap) -> Spritemap:
+        return Spritemap(self.array()[spritemap.array()], *spritemap.size)
+
+    def changes(self) -> list[tuple[int, int]]:
+        # the (index, colour) entries that differ from the identity
+        return [(key, value) for key, value in enumerate(self.data) if key != value]
+
+
+class RecolourWriter:
+    # streams recolour_sprite blocks into an open (buffered) file. The
+    # "0xKK:" and "0xVV;" halves of every entry are formatted once, writing
+    # an entry only joins two of them
+    keys = [f"0x{key:02x}:" for key in range(256)]
+    values = [f"0x{value:02x};" for value in range(256)]
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, name: str, rec) -> int:
+        # writes one block, returns the number of recoloured entries
+        keys, values = self.keys, self.values
+        entries = [
+            keys[key] + values[value]
+            for key, value in enumerate(RecolourTable.of(rec).data)
+            if key != value
+        ]
+        parts = ["recolour_sprite {\n    // ", str(name)]
+        for i in range(0, len(entries), 8):
+            parts.append("\n    ")
+            parts.extend(entries[i : i + 8])
+        parts.append("\n}\n")
+        self.file.write("".join(parts))
+        return len(entries)
+
+
+def format_recolour_data(recolour_data: dict[dict]) -> dict:
+    with profiler.stage("format"):
+        f = {}
+        for name, rec in recolour_data.items():
+            block = io.StringIO()
+            counter = RecolourWriter(block).write(name, rec)
+            Print.info(f"Used colours: {counter} ({name})")
+            f[name] = block.getvalue()
+        return f
+
+
+def write_recolour(filename: str, recolour_data: dict[dict]) -> None:
+    with open(filename, "w+", buffering=1 << 16) as f:
+        writer = RecolourWriter(f)
+        with profiler.stage("format"):
+            for name, rec in recolour_data.items():
+                counter = writer.write(name, rec)
+                Print.info(f"Used colours: {counter} ({name})")
+    Print.info(f"Recolour data written to {filename}")
+
+
+def write_recolour_files(recolour_files: dict[str, list[dict]]) -> None:
+    # many jobs' recolour sprites into one or more include files, each file
+    # opened once and written in a single pass in the order given
+    for filename, recolour_data in recolour_files.items():
+        with open(filename, "w+", buffering=1 << 16) as f:
+            writer = RecolourWriter(f)
+            with profiler.stage("format"):
+                for data in recolour_data:
+                    for name, rec in data.items():
+                        writer.write(name, rec)
+        Print.info(f"Recolour data written to {filename}")
+
+
+def copyright():
+    from datetime import datetime
+
+    Print.info("blend.py - A tool to blend multiple images together")
+    Print.info(f"Copyright 2024-{datetime.now().year} WenSim <wensimehrp@gmail.com>")
+    Print.info("Licensed under the MIT License")
+    Print.info("")
@@ -0,0 +1,140 @@
+from blend import ProcessImage, profiler
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+# reading and inflating a png mostly waits on the disk and zlib, both of which
+# let go of the GIL, so a few threads overlap the waits of a whole job
+LOADER_THREADS = 4
+# images decoded (or being decoded) ahead of the one the blend is on
+MAX_PENDING = 8
+# jobs of a batch whose input files are read ahead of the running ones
+PREFETCH_JOBS = 4
+
+
+def _decode(image: ProcessImage) -> ProcessImage:
+    image.spritemap
+    image.palette
+    return image
+
+
+class ImageLoader:
+    # decodes images on a bounded thread pool and hands them out in order as
+    # each becomes ready, so the blend starts on the first pair while the rest
+    # still load. At most `max_pending` images are in flight ahead of the one
+    # last handed out, a slow consumer holds back the decoding rather than
+    # piling up planes in memory
+    def __init__(
+        self,
+        threads: int = LOADER_THREADS,
+        max_pending: int = MAX_PENDING,
+        decode_cache=None,
+    ):
+        self.max_pending = max(1, max_pending)
+        self.decode_cache = decode_cache
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="loader"
+        )
+
+    def load(self, image_paths: list[str]):
+        # yields a decoded ProcessImage per path, in order. A path given twice
+        # is decoded once. A failed decode raises (or exits, as Print.error
+        # does) when its image is reached
+        if profiler.memory:
+            # tracemalloc has one peak for the whole process, decodes on other
+            # threads would reset it under the stages of this one
+            yield from self._load_serially(image_paths)
+            return
+        futures = {}
+        pending = deque()
+        paths = iter(image_paths)
+
+        def fill():
+            while len(pending) < self.max_pending:
+                image_path = next(paths, None)
+                if image_path is None:
+                    return
+                if image_path not in futures:
+                    futures[image_path] = self.executor.submit(
+                        _decode, ProcessImage(image_path, self.decode_cache)
+                    )
+                pending.append(futures[image_path])
+
+        fill()
+        try:
+            while pending:
+                image = pending.popleft().result()
+                fill()
+                yield image
+        finally:
+            # the consumer stopped early (or failed), don't decode the rest
+            for future in pending:
+                future.cancel()
+
+    def _load_serially(self, image_paths: list[str]):
+        decoded = {}
+        for image_path in image_paths:
+            if image_path not in decoded:
+                decoded[image_path] = _decode(
+                    ProcessImage(image_path, self.decode_cache)
+                )
+            yield decoded[image_path]
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read(image_path: str) -> None:
+    # pulls the file into the OS page cache, the worker decoding it later
+    # reads memory instead of waiting on (networked) storage
+    try:
+        with open(image_path, "rb", buffering=0) as f:
+            while f.read(1 << 20):
+                pass
+    except OSError:
+        # the job reports missing files itself
+        pass
+
+
+class Prefetcher:
+    # reads the inputs of the next jobs of a batch on a few threads of the
+    # main process. Only `jobs` jobs past the last one finished are read ahead,
+    # so a long batch never pulls in more than the workers will soon use
+    def __init__(
+        self,
+        jobs: list[dict],
+        ahead: int = PREFETCH_JOBS,
+        threads: int = LOADER_THREADS,
+    ):
+        self.jobs = jobs
+        self.ahead = ahead
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="prefetch"
+        )
+        self.next_job = 0
+        self.read = set()
+
+    def advance(self, finished: int) -> None:
+        # call with the number of jobs finished so far
+        while self.next_job < min(len(self.jobs), finished + self.ahead):
+            for image_path in self.jobs[self.next_job]["inputs"]:
+                key = os.path.abspath(image_path)
+                if key not in self.read:
+                    self.read.add(key)
+                    self.executor.submit(_read, image_path)
+            self.next_job += 1
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
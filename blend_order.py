@@ -0,0 +1,116 @@
+from blend import BlendImages, Print, ProcessImage, check_same_size
+import itertools
+import numpy as np
+import time
+
+# orders are tried exhaustively up to this many images, beyond it the search
+# tries every reference image and then swaps pairs while that helps
+EXHAUSTIVE_IMAGES = 6
+
+_identity = np.arange(256, dtype=np.uint8)
+
+
+class OrderSearch:
+    # scores input orders of one set of images. The distinct colour tuples are
+    # found once, any other order is the same tuples with their columns
+    # permuted and the same first occurrences, so scoring an order only runs
+    # the pairwise chain over a few hundred tuples instead of re-blending
+    def __init__(self, images: list, reserved: frozenset = frozenset()):
+        self.tuples, self.first_index, _, self.pixels = BlendImages.distinct_tuples(
+            images, return_inverse=False
+        )
+        self.reserved = reserved
+        self.scores = {}
+
+    def score(self, order: tuple) -> tuple:
+        # (recolour entries, palette slots), lower is better, None if the
+        # order doesn't fit in 256 colours
+        if order not in self.scores:
+            _, steps, slots = BlendImages.chain_tuples(
+                self.tuples[:, order],
+                self.first_index,
+                self.pixels,
+                self.reserved,
+                stop_on_overflow=True,
+            )
+            if slots > 256:
+                self.scores[order] = None
+            else:
+                tables = BlendImages._chain_recolour_dicts(steps)
+                entries = sum(
+                    int(np.count_nonzero(table.array() != _identity))
+                    for table in tables
+                )
+                self.scores[order] = (entries, slots)
+        return self.scores[order]
+
+    def better(self, order: tuple, than: tuple) -> bool:
+        score, other = self.score(order), self.score(than)
+        return score is not None and (other is None or score < other)
+
+    def _candidates(self, order: tuple):
+        # every image as the reference (first, so its recolour stays identity)
+        # with the rest kept in order, then every swap of two positions
+        for image in order[1:]:
+            yield (image,) + tuple(other for other in order if other != image)
+        for i, j in itertools.combinations(range(len(order)), 2):
+            swapped = list(order)
+            swapped[i], swapped[j] = swapped[j], swapped[i]
+            yield tuple(swapped)
+
+    def search(self, seconds: float) -> tuple:
+        # the best order found within `seconds`, ties keep the earlier one
+        deadline = time.perf_counter() + seconds
+        count = self.tuples.shape[1]
+        best = tuple(range(count))
+        self.score(best)
+        if len(self.tuples) > 256:
+            # every distinct tuple is an output colour, no order can fit
+            return best
+        if count <= EXHAUSTIVE_IMAGES:
+            for order in itertools.permutations(range(count)):
+                if time.perf_counter() > deadline:
+                    break
+                if self.better(order, best):
+                    best = order
+            return best
+        improved = True
+        while improved and time.perf_counter() <= deadline:
+            improved = False
+            for order in self._candidates(best):
+                if time.perf_counter() > deadline:
+                    break
+                if self.better(order, best):
+                    best = order
+                    improved = True
+                    break
+        return best
+
+
+def optimize_order(
+    image_paths: list[str],
+    seconds: float = 2.0,
+    decode_cache=None,
+    reserved: frozenset = frozenset(),
+) -> tuple[list[str], list[ProcessImage]]:
+    # the input order with the fewest recolour entries (then palette slots)
+    # found within `seconds`, with a report of what it saves. The decoded
+    # images come back in that order too, for the blend to use
+    images = [ProcessImage(image_path, decode_cache) for image_path in image_paths]
+    check_same_size(images)
+    search = OrderSearch(images, reserved)
+    order = search.search(seconds)
+
+    def describe(score):
+        if score is None:
+            return "more than 256 colours"
+        return f"{score[0]} recolour entries, {score[1]} palette slots"
+
+    Print.info(f"Orders tried     : {len(search.scores)}")
+    Print.info(
+        f"Input order      : {describe(search.score(tuple(range(len(images)))))}"
+    )
+    Print.info(f"Chosen order     : {describe(search.score(order))}")
+    for image in order:
+        Print.info(f"  {image_paths[image]}")
+    return ([image_paths[image] for image in order], [images[image] for image in order])
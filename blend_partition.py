@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+from blend import (
+    BlendImages,
+    Print,
+    ProcessImage,
+    RecolourTable,
+    Spritemap,
+    check_inputs,
+    process_image,
+    write_image,
+    write_recolour,
+)
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# fit checks the search for fewer groups may spend after first fit
+SEARCH_CHECKS = 256
+
+
+class TupleGroup:
+    # the distinct colour tuples of a group of images, grown one image at a
+    # time. Every pixel keeps the id of its tuple, so adding an image is one
+    # unique over id * 256 + colour. A group that fits has at most 256 tuples,
+    # which keeps those keys within 16 bits
+    def __init__(
+        self,
+        members: list[int],
+        ids: np.ndarray,
+        tuples: np.ndarray,
+        first_index: np.ndarray,
+    ):
+        self.members = members
+        self.ids = ids
+        self.tuples = tuples
+        self.first_index = first_index
+
+    @classmethod
+    def of(cls, member: int, plane: np.ndarray) -> "TupleGroup":
+        colours, first_index, ids = np.unique(
+            plane, return_index=True, return_inverse=True
+        )
+        return cls([member], ids.ravel(), colours[:, None], first_index)
+
+    def with_image(self, member: int, plane: np.ndarray) -> "TupleGroup":
+        keys, first_index, ids = np.unique(
+            self.ids.astype(np.uint16) * 256 + plane,
+            return_index=True,
+            return_inverse=True,
+        )
+        tuples = np.column_stack((self.tuples[keys >> 8], plane[first_index]))
+        return TupleGroup(self.members + [member], ids.ravel(), tuples, first_index)
+
+    def fits(self, reserved: frozenset = frozenset()) -> bool:
+        # every distinct tuple is an output colour, more than 256 never fit
+        if len(self.tuples) > 256:
+            return False
+        _, _, slots = BlendImages.chain_tuples(
+            self.tuples, self.first_index, len(self.ids), reserved, True
+        )
+        return slots <= 256
+
+
+def _first_fit(
+    planes: list[np.ndarray], order: list[int], reserved: frozenset
+) -> list[TupleGroup]:
+    # each image joins the first group it still fits in, or starts a new one.
+    # A single image is its own blend and always fits
+    groups = []
+    for member in order:
+        for i, group in enumerate(groups):
+            grown = group.with_image(member, planes[member])
+            if grown.fits(reserved):
+                groups[i] = grown
+                break
+        else:
+            groups.append(TupleGroup.of(member, planes[member]))
+    return groups
+
+
+def _search(
+    planes: list[np.ndarray], limit: int, reserved: frozenset, budget: list[int]
+) -> list[TupleGroup]:
+    # depth first search for a split into at most `limit` groups, giving up
+    # (None) once budget[0] fit checks are spent
+    def place(member: int, groups: list[TupleGroup]):
+        if member == len(planes):
+            return groups
+        for i, group in enumerate(groups):
+            if budget[0] <= 0:
+                return None
+            budget[0] -= 1
+            grown = group.with_image(member, planes[member])
+            if grown.fits(reserved):
+                found = place(member + 1, groups[:i] + [grown] + groups[i + 1 :])
+                if found is not None:
+                    return found
+        # a new group is the same whichever empty group it is, so try it once
+        if len(groups) < limit:
+            return place(member + 1, groups + [TupleGroup.of(member, planes[member])])
+        return None
+
+    return place(0, [])
+
+
+def partition(
+    planes: list[np.ndarray],
+    reserved: frozenset = frozenset(),
+    search_checks: int = SEARCH_CHECKS,
+) -> list[list[int]]:
+    # splits the images (flat index planes) into few groups that each fit.
+    # First fit, in input order and with the most colourful images first,
+    # gives a split, then a bounded search looks for one with fewer groups.
+    # Returns the indices of every group in input order
+    colours = [len(np.unique(plane)) for plane in planes]
+    orders = [
+        list(range(len(planes))),
+        sorted(range(len(planes)), key=lambda i: -colours[i]),
+    ]
+    best = None
+    for order in orders:
+        groups = _first_fit(planes, order, reserved)
+        if best is None or len(groups) < len(best):
+            best = groups
+        if len(best) == 1:
+            break
+    budget = [search_checks]
+    while len(best) > 1:
+        found = _search(planes, len(best) - 1, reserved, budget)
+        if found is None:
+            break
+        best = found
+
+    partitions = []
+    for group in best:
+        members = sorted(group.members)
+        if members != group.members:
+            # the chain order decides the slots, keep input order if it fits
+            ordered = TupleGroup.of(members[0], planes[members[0]])
+            for member in members[1:]:
+                ordered = ordered.with_image(member, planes[member])
+            if not ordered.fits(reserved):
+                members = group.members
+        partitions.append(members)
+    return sorted(partitions)
+
+
+def load_images(image_paths: list[str], decode_cache: str = None) -> list:
+    if decode_cache is not None:
+        from blend_cache import DecodeCache
+
+        decode_cache = DecodeCache(decode_cache)
+    return [ProcessImage(image_path, decode_cache) for image_path in image_paths]
+
+
+def blend_group(
+    image_paths: list[str],
+    engine: str = "pairkey",
+    decode_cache: str = None,
+    reserved: frozenset = frozenset(),
+) -> tuple:
+    # returns the blend as plain bytes, a Spritemap doesn't cross processes
+    if len(image_paths) == 1:
+        image = load_images(image_paths, decode_cache)[0]
+        spritemap, palette = image.spritemap, image.palette
+        recolour_sprites = {image_paths[0]: RecolourTable()}
+    else:
+        if decode_cache is not None:
+            from blend_cache import DecodeCache
+
+            decode_cache = DecodeCache(decode_cache)
+        spritemap, palette, recolour_sprites = process_image(
+            image_paths, engine, False, decode_cache, reserved
+        )
+    return (spritemap.tobytes(), spritemap.size, palette, recolour_sprites)
+
+
+def process_partitioned(
+    image_paths: list[str],
+    engine: str = "pairkey",
+    workers: int = None,
+    decode_cache: str = None,
+    reserved: frozenset = frozenset(),
+) -> tuple[list[list[str]], list[tuple]]:
+    # with a decode cache the groups read back the planes decoded here
+    images = load_images(image_paths, decode_cache)
+    planes = [image.spritemap.array().ravel() for image in images]
+    groups = [
+        [image_paths[i] for i in members] for members in partition(planes, reserved)
+    ]
+    del images, planes
+    Print.info(f"Groups           : {len(groups)}")
+
+    if workers == 1 or len(groups) <= 1:
+        results = [
+            blend_group(group, engine, decode_cache, reserved) for group in groups
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(blend_group, group, engine, decode_cache, reserved)
+                for group in groups
+            ]
+            results = [future.result() for future in futures]
+    return (groups, results)
+
+
+def run(
+    files: list[str],
+    *,
+    engine: str = "pairkey",
+    workers: int = None,
+    decode_cache: str = None,
+    reserved: frozenset = frozenset(),
+    dry_run: bool = False,
+) -> None:
+    # group n goes to output_n.png and recolour_n.txt
+    import time
+
+    start = time.time()
+    problems = check_inputs(files)
+    if problems:
+        Print.error(*problems, sep="\n       ")
+
+    if dry_run:
+        images = load_images(files, decode_cache)
+        planes = [image.spritemap.array().ravel() for image in images]
+        for n, members in enumerate(partition(planes, reserved), 1):
+            if len(members) == 1:
+                Print.info(f"Group {n}: a single image, kept as it is")
+            else:
+                colours, slots = BlendImages.predict(
+                    [images[i] for i in members], reserved
+                )
+                Print.info(f"Group {n}: {colours} colours, {slots} of 256 slots")
+            for i in members:
+                Print.info(f"  {files[i]}")
+        return
+
+    groups, results = process_partitioned(
+        files, engine, workers, decode_cache, reserved
+    )
+    for n, (group, result) in enumerate(zip(groups, results), 1):
+        data, (width, height), palette, recolour_sprites = result
+        Print.info(f"Group {n}: {', '.join(group)}")
+        write_image(f"output_{n}.png", Spritemap(data, width, height), palette)
+        write_recolour(f"recolour_{n}.txt", recolour_sprites)
+
+    Print.info("Finished processing images")
+    Print.info(f"Time taken: {time.time() - start:.2f}s")
+
+
+def main():
+    from blend_cli import script
+
+    script("partition")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from blend import gen_recolour_sprite, Print, write_recolour, copyright
+from blend_core import Print, RecolourTable, write_recolour, copyright
 import sys
 import re
 
@@ -22,8 +22,9 @@ if __name__ == "__main__":
         recolour_sprites[i].update(new_recolour_sprites)
 
     try:
-        write_recolour("new_recolour.txt",{"new_recolour.txt":gen_recolour_sprite(recolour_sprites[0], recolour_sprites[1])})
-    except KeyError:
+        tables = [RecolourTable.of(rec) for rec in recolour_sprites]
+        write_recolour("new_recolour.txt",{"new_recolour.txt":tables[0].compose(tables[1])})
+    except (KeyError, ValueError):
         Print.error("Recolour sprites don't match")
         sys.exit(1)
     except Exception as e:
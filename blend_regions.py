@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+from blend import (
+    ENGINE_VERSION,
+    BlendImages,
+    Print,
+    ProcessImage,
+    ProcessedImage,
+    Spritemap,
+    check_inputs,
+    check_same_size,
+    write_image,
+    write_recolour,
+)
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import numpy as np
+
+
+def _runs(flags: np.ndarray) -> list[tuple[int, int]]:
+    # (start, end) of every run of True values
+    edges = np.diff(np.concatenate(([0], flags.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def detect_regions(planes: list[np.ndarray]) -> list[tuple[int, int, int, int]]:
+    # recursively cut the sheet along rows and columns that are transparent
+    # (index 0) in every input, what is left are the individual sprites
+    mask = np.zeros(planes[0].shape, dtype=bool)
+    for plane in planes:
+        mask |= plane != 0
+
+    height, width = mask.shape
+    regions = []
+    boxes = [(0, 0, width, height)]
+    while boxes:
+        left, top, right, bottom = boxes.pop()
+        box = mask[top:bottom, left:right]
+        row_runs = _runs(box.any(axis=1))
+        column_runs = _runs(box.any(axis=0))
+        if not row_runs:
+            continue
+        if len(row_runs) == 1 and len(column_runs) == 1:
+            (y0, y1), (x0, x1) = row_runs[0], column_runs[0]
+            regions.append(
+                (left + int(x0), top + int(y0), left + int(x1), top + int(y1))
+            )
+        elif len(row_runs) > 1:
+            boxes.extend(
+                (left, top + int(y0), right, top + int(y1)) for y0, y1 in row_runs
+            )
+        else:
+            boxes.extend(
+                (left + int(x0), top, left + int(x1), bottom) for x0, x1 in column_runs
+            )
+    return sorted(regions, key=lambda region: (region[1], region[0]))
+
+
+def blend_region(
+    crops: list[bytes], width: int, height: int, reserved: frozenset = frozenset()
+) -> tuple[bytes, list[dict]]:
+    patients = [ProcessedImage(Spritemap(crop, width, height)) for crop in crops]
+    blended = BlendImages(patients, reserved)
+    return (blended.spritemap.tobytes(), blended.recolour_dicts)
+
+
+def region_key(
+    crops: list[bytes], width: int, height: int, reserved: frozenset = frozenset()
+) -> str:
+    digest = hashlib.blake2b(
+        f"region {ENGINE_VERSION} {width}x{height}".encode(), digest_size=20
+    )
+    if reserved:
+        digest.update(f"reserved {sorted(reserved)}".encode())
+    for crop in crops:
+        digest.update(hashlib.blake2b(crop).digest())
+    return digest.hexdigest()
+
+
+def process_regions(
+    image_paths: list[str],
+    regions: list[tuple[int, int, int, int]] = None,
+    workers: int = None,
+    cache=None,
+    reserved: frozenset = frozenset(),
+) -> tuple:
+    # blends every region on its own, returns the whole sheet, the palette and
+    # one recolour set per region and input
+    images = [ProcessImage(image_path) for image_path in image_paths]
+    check_same_size(images)
+    planes = [image.spritemap.array() for image in images]
+    if regions is None:
+        regions = detect_regions(planes)
+    Print.info(f"Regions          : {len(regions)}")
+
+    output = planes[0].copy()
+    covered = np.zeros(output.shape, dtype=bool)
+    jobs = {}
+    keys = []
+    for region in regions:
+        left, top, right, bottom = region
+        if not (
+            0 <= left < right <= output.shape[1]
+            and 0 <= top < bottom <= output.shape[0]
+        ):
+            Print.error(
+                f"Region {region} is outside the {output.shape[1]}x{output.shape[0]} sheet"
+            )
+        covered[top:bottom, left:right] = True
+        crops = [plane[top:bottom, left:right].tobytes() for plane in planes]
+        # identical regions, in this sheet or from an earlier run, blend once
+        key = region_key(crops, right - left, bottom - top, reserved)
+        jobs.setdefault(key, (crops, right - left, bottom - top))
+        keys.append(key)
+
+    if any(
+        not np.array_equal(plane[~covered], planes[0][~covered]) for plane in planes[1:]
+    ):
+        Print.warn("Inputs differ outside the regions, using the first image there")
+
+    results = {}
+    pending = {}
+    for key, (crops, width, height) in jobs.items():
+        if cache is not None:
+            cached = cache.load(key, image_paths)
+            if cached is not None:
+                cache.hits += 1
+                results[key] = (
+                    cached[0].tobytes(),
+                    [cached[2][image_path] for image_path in image_paths],
+                )
+                continue
+            cache.misses += 1
+        pending[key] = (crops, width, height)
+    Print.info(f"Unique regions   : {len(jobs)} ({len(jobs) - len(pending)} cached)")
+
+    # a region that doesn't fit would only fail inside a worker, check them
+    # all up front and name every box that needs too many colours
+    overflowing = {}
+    for key, (crops, width, height) in pending.items():
+        patients = [ProcessedImage(Spritemap(crop, width, height)) for crop in crops]
+        colours, slots = BlendImages.predict(patients, reserved)
+        if slots > 256:
+            overflowing[key] = (colours, slots)
+    if overflowing:
+        Print.error(
+            "impossible to process as these regions require more than 256 colours",
+            *(
+                f"{left},{top},{right},{bottom}: {overflowing[key][0]} colours,"
+                f" {overflowing[key][1]} palette slots"
+                for (left, top, right, bottom), key in zip(regions, keys)
+                if key in overflowing
+            ),
+            sep="\n       ",
+        )
+
+    if workers == 1 or len(pending) <= 1:
+        for key, job in pending.items():
+            results[key] = blend_region(*job, reserved)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                key: executor.submit(blend_region, *job, reserved)
+                for key, job in pending.items()
+            }
+            for key, future in futures.items():
+                results[key] = future.result()
+
+    if cache is not None:
+        for key, (_, width, height) in pending.items():
+            blended, recolour_dicts = results[key]
+            recolour_sprites = dict(zip(image_paths, recolour_dicts))
+            cache.store(
+                key,
+                image_paths,
+                (Spritemap(blended, width, height), [], recolour_sprites),
+            )
+
+    recolour_sprites = {}
+    for (left, top, right, bottom), key in zip(regions, keys):
+        blended, recolour_dicts = results[key]
+        output[top:bottom, left:right] = np.frombuffer(blended, dtype=np.uint8).reshape(
+            bottom - top, right - left
+        )
+        for image_path, recolour_dict in zip(image_paths, recolour_dicts):
+            recolour_sprites[f"{image_path} @ {left},{top},{right},{bottom}"] = (
+                recolour_dict
+            )
+
+    height, width = output.shape
+    return (Spritemap(output, width, height), images[0].palette, recolour_sprites)
+
+
+def run(
+    files: list[str],
+    *,
+    regions: list = None,
+    workers: int = None,
+    cache_dir: str = None,
+    reserved: frozenset = frozenset(),
+) -> None:
+    # writes output.png and recolour.txt, one recolour sprite per region and
+    # input
+    import time
+
+    start = time.time()
+    problems = check_inputs(files)
+    if problems:
+        Print.error(*problems, sep="\n       ")
+
+    cache = None
+    if cache_dir is not None:
+        from blend_cache import ResultCache
+
+        cache = ResultCache(cache_dir)
+
+    spritemap, palette, recs = process_regions(files, regions, workers, cache, reserved)
+    write_image("output.png", spritemap, palette)
+    write_recolour("recolour.txt", recs)
+    if cache is not None:
+        cache.report()
+
+    Print.info("Finished processing images")
+    Print.info(f"Time taken: {time.time() - start:.2f}s")
+
+
+def main():
+    from blend_cli import script
+
+    script("regions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+from blend import Print
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import threading
+import time
+
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+# durations kept for the status endpoint
+RECENT_REQUESTS = 64
+
+
+def _warm() -> None:
+    # runs once in every worker, so no request pays for the imports
+    import importlib
+    from PIL import Image
+
+    importlib.import_module("blend")
+    Image.init()
+
+
+def outside(root: str, paths: list[str]) -> list[str]:
+    # the paths that don't resolve to `root` or a file below it
+    return [
+        path
+        for path in paths
+        if os.path.commonpath([root, os.path.realpath(path)]) != root
+    ]
+
+
+def run_blend(argv: list[str], cwd: str, root: str) -> tuple[int, str, str]:
+    # one blend.py run inside a worker: the same arguments, relative paths
+    # resolved against the client's directory and everything it printed
+    # returned. Every file it reads or writes must be under `root`. A worker
+    # runs one request at a time, so changing directory is safe here
+    import blend
+    from blend_cli import script_parser
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    code = 0
+    try:
+        os.chdir(cwd)
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            options = script_parser("blend").parse_args(argv)
+            # these delete or list a directory rather than blend, a request
+            # mustn't be able to do that
+            if options.clear or options.info:
+                blend.Print.error(
+                    "--clear and --info aren't run by the server, use blend.py"
+                )
+            # profile.json is written to cwd, which is already under root
+            paths = options.images + [options.output, options.recolour]
+            paths += [
+                path
+                for path in (options.cache, options.decode_cache)
+                if path is not None
+            ]
+            refused = outside(root, paths)
+            if refused:
+                blend.Print.error(f"{', '.join(refused)} outside of {root}")
+            options.run(options)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        stderr.write(
+            Print.colour(f"Error: blend failed, {type(e).__name__}, {e}", "red") + "\n"
+        )
+        code = 1
+    finally:
+        # a run that stopped half way mustn't leave profiling on for the next
+        blend.profiler.stop()
+    return (code, stdout.getvalue(), stderr.getvalue())
+
+
+class BlendService:
+    # a pool of workers that have already imported blend.py, and the numbers
+    # behind the status endpoint. Requests beyond `max_pending` (running plus
+    # queued) are turned away, the client then blends on its own
+    def __init__(self, workers: int = None, max_pending: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.executor = self._start()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.pending = 0
+        self.most_pending = 0
+        self.requests = 0
+        self.failed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.seconds = 0.0
+        self.recent = []
+
+    def _start(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm)
+        # start every worker now rather than on the first requests
+        for future in [executor.submit(time.sleep, 0) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        # a worker died (killed, out of memory), which breaks the whole pool.
+        # Only the first request to notice replaces it
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.restarts += 1
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.executor = self._start()
+
+    def blend(self, argv: list[str], cwd: str, root: str):
+        # (code, stdout, stderr), or None when the service is full or lost its
+        # workers, the client then blends on its own
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return None
+            self.pending += 1
+            self.most_pending = max(self.most_pending, self.pending)
+        start = time.perf_counter()
+        executor = self.executor
+        try:
+            result = executor.submit(run_blend, argv, cwd, root).result()
+        except BrokenProcessPool:
+            self._restart(executor)
+            result = None
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.pending -= 1
+                self.requests += 1
+                self.seconds += seconds
+                self.recent = (self.recent + [round(seconds, 4)])[-RECENT_REQUESTS:]
+        if result is None or result[0] != 0:
+            with self.lock:
+                self.failed += 1
+        return result
+
+    def status(self) -> dict:
+        with self.lock:
+            running = min(self.pending, self.workers)
+            return {
+                "uptime": round(time.time() - self.started, 1),
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self.pending,
+                "running": running,
+                "queued": self.pending - running,
+                "most_pending": self.most_pending,
+                "requests": self.requests,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "restarts": self.restarts,
+                "mean_seconds": (
+                    round(self.seconds / self.requests, 4) if self.requests else None
+                ),
+                "recent_seconds": self.recent,
+            }
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
+
+
+class BlendHandler(BaseHTTPRequestHandler):
+    # POST /blend {"argv": [...], "cwd": "..."} and GET /status, both JSON.
+    # Requests from a browser are refused: they carry an Origin header, and a
+    # page can only send JSON after a CORS preflight, which is never answered.
+    # `cwd` must lie under `root`
+    service: BlendService = None
+    root: str = None
+
+    def _reply(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _refuse(self) -> bool:
+        # replies and returns True for a request that may come from a web page
+        if self.headers.get("Origin") is not None:
+            self._reply(403, {"error": "requests from a browser are refused"})
+            return True
+        return False
+
+    def do_GET(self):
+        if self._refuse():
+            return
+        if self.path == "/status":
+            self._reply(200, self.service.status())
+        else:
+            self._reply(404, {"error": f"unknown endpoint {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/blend":
+            self._reply(404, {"error": f"unknown endpoint {self.path}"})
+            return
+        if self._refuse():
+            return
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.split(";")[0].strip().lower() != "application/json":
+            self._reply(415, {"error": "expected Content-Type application/json"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            argv, cwd = [str(arg) for arg in request["argv"]], str(request["cwd"])
+        except (TypeError, ValueError, KeyError) as e:
+            self._reply(400, {"error": f"bad request, {type(e).__name__}, {e}"})
+            return
+        cwd = os.path.realpath(cwd)
+        if not os.path.isdir(cwd) or outside(self.root, [cwd]):
+            self._reply(403, {"error": f"{cwd} is not a directory under {self.root}"})
+            return
+        result = self.service.blend(argv, cwd, self.root)
+        if result is None:
+            self._reply(503, {"error": "busy or restarting"})
+            return
+        code, stdout, stderr = result
+        self._reply(200, {"code": code, "stdout": stdout, "stderr": stderr})
+
+    def log_message(self, format, *args):
+        # one line per request would bury the startup message
+        pass
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def run(
+    *,
+    address: str = None,
+    workers: int = None,
+    max_pending: int = None,
+    root: str = ".",
+) -> None:
+    # serves until interrupted, only for clients in `root` or below it
+    if address is None:
+        address = os.environ.get("BLEND_SERVER", DEFAULT_ADDRESS)
+    try:
+        host, port = parse_address(address)
+    except ValueError:
+        Print.error(f"Invalid address {address}, expected HOST:PORT")
+
+    if not os.path.isdir(root):
+        Print.error(f"--root {root} is not a directory")
+
+    service = BlendService(workers, max_pending)
+    BlendHandler.service = service
+    BlendHandler.root = os.path.realpath(root)
+    try:
+        server = ThreadingHTTPServer((host, port), BlendHandler)
+    except OSError as e:
+        service.close()
+        Print.error(f"failed to listen on {address}, {e}")
+    Print.info(
+        f"Serving on http://{host}:{port} with {service.workers} workers for"
+        f" {BlendHandler.root}, press Ctrl+C to stop"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        Print.info("Stopped serving")
+    finally:
+        server.server_close()
+        service.close()
+
+
+def main():
+    from blend_cli import script
+
+    script("serve")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+from blend import (
+    BlendImages,
+    CompareImage,
+    Print,
+    ProcessImage,
+    profiler,
+    size_problem,
+)
+from blend_cache import DecodeCache
+import numpy as np
+import struct
+import tempfile
+import zlib
+
+# rough bytes needed per pixel of a band on top of the input rows: pair keys,
+# np.unique's sort and index arrays and the output row
+BAND_BYTES_PER_PIXEL = 24
+
+
+class PngWriter:
+    # writes an indexed png row band by row band, so the whole output never
+    # has to exist in memory at once
+    def __init__(
+        self,
+        filename: str,
+        width: int,
+        height: int,
+        palette: list,
+        compress_level: int = None,
+    ):
+        self.file = open(filename, "wb")
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if compress_level is None else compress_level
+        )
+
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+        if palette:
+            palette = list(palette)[: 256 * 3]
+            palette += [0] * (-len(palette) % 3)
+            self._chunk(b"PLTE", bytes(palette))
+
+    def _chunk(self, kind: bytes, data: bytes) -> None:
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_rows(self, rows: np.ndarray) -> None:
+        # every row is prefixed by filter type 0 (none)
+        filtered = np.zeros((rows.shape[0], self.width + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+        self.rows_written += rows.shape[0]
+
+    def close(self) -> None:
+        if self.rows_written != self.height:
+            Print.error(f"wrote {self.rows_written} of {self.height} rows")
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+class StreamBlend:
+    # the pairwise chain run over row bands of memory mapped index planes.
+    # Each step first streams the sheet to find every pair and where it first
+    # occurs, which is all the allocation needs to hand out the same indices
+    # as the in-memory engines, then the final pass writes the output
+    def __init__(
+        self,
+        image_paths: list[str],
+        memory_budget: int,
+        decode_cache=None,
+        reserved: frozenset = frozenset(),
+    ):
+        if len(image_paths) < 2:
+            Print.error("Please provide at least two images to blend")
+        self.image_paths = image_paths
+        self.memory_budget = memory_budget
+        self.reserved = reserved
+        self._temp_dir = None
+        if decode_cache is None:
+            self._temp_dir = tempfile.TemporaryDirectory()
+            decode_cache = DecodeCache(self._temp_dir.name)
+        self.decode_cache = decode_cache
+
+        self.planes, self.palette = self._map_inputs()
+        self.width, self.height = self.planes[0].size
+        for image_path, plane in zip(self.image_paths[1:], self.planes[1:]):
+            if not plane.size == self.planes[0].size:
+                Print.error(
+                    size_problem(
+                        self.image_paths[0], self.planes[0].size, image_path, plane.size
+                    )
+                )
+        self.pixels = self.width * self.height
+        self.band_rows = self._band_rows()
+        self.lookups = []
+
+    def _map_inputs(self):
+        planes = []
+        palette = None
+        for image_path in self.image_paths:
+            cached = self.decode_cache.load(image_path)
+            if cached is None:
+                # decode one png at a time and drop it once it is on disk
+                image = ProcessImage(image_path)
+                self.decode_cache.store(image_path, image.spritemap, image.palette)
+                del image
+                cached = self.decode_cache.load(image_path)
+            planes.append(cached[0])
+            if palette is None:
+                palette = cached[1]
+        return (planes, palette)
+
+    def _band_rows(self) -> int:
+        row_bytes = self.width * (len(self.planes) + BAND_BYTES_PER_PIXEL)
+        return max(1, min(self.height, self.memory_budget // max(row_bytes, 1)))
+
+    def _bands(self):
+        for top in range(0, self.height, self.band_rows):
+            yield top, min(top + self.band_rows, self.height)
+
+    def _band(self, index: int, top: int, bottom: int) -> np.ndarray:
+        return self.planes[index].array()[top:bottom].ravel()
+
+    def _blended_band(self, step: int, top: int, bottom: int) -> np.ndarray:
+        # the chain output after `step` images for rows top..bottom
+        current = self._band(0, top, bottom)
+        for i, lookup in enumerate(self.lookups[:step], 1):
+            current = lookup[
+                current.astype(np.uint16) * 256 + self._band(i, top, bottom)
+            ]
+        return current
+
+    @staticmethod
+    def _ordered_colours(first: np.ndarray, pixels: int) -> set:
+        # distinct colours fed in first occurrence order, see BlendImages
+        colours = np.nonzero(first < pixels)[0]
+        return set(colours[np.argsort(first[colours], kind="stable")].tolist())
+
+    def _step(self, step: int) -> tuple[dict, dict]:
+        with profiler.stage("recinfo"):
+            return self._scan_step(step)
+
+    def _scan_step(self, step: int) -> tuple[dict, dict]:
+        first = np.full(256 * 256, self.pixels, dtype=np.int64)
+        for top, bottom in self._bands():
+            keys = self._blended_band(step - 1, top, bottom).astype(np.uint16) * 256
+            keys += self._band(step, top, bottom)
+            band_keys, band_first = np.unique(keys, return_index=True)
+            np.minimum.at(first, band_keys, band_first + top * self.width)
+
+        keys = np.nonzero(first < self.pixels)[0]
+        pair_first = first[keys]
+        first1 = np.full(256, self.pixels, dtype=np.int64)
+        first2 = np.full(256, self.pixels, dtype=np.int64)
+        np.minimum.at(first1, keys >> 8, pair_first)
+        np.minimum.at(first2, keys & 0xFF, pair_first)
+        lookup, recolour_dict1, recolour_dict2 = CompareImage.assign_pairs(
+            keys,
+            pair_first,
+            self._ordered_colours(first1, self.pixels),
+            self._ordered_colours(first2, self.pixels),
+            self.reserved,
+        )
+        full_lookup = np.zeros(256 * 256, dtype=np.uint8)
+        full_lookup[keys] = lookup
+        self.lookups.append(full_lookup)
+        return (recolour_dict1, recolour_dict2)
+
+    def run(self, filename: str, compress_level: int = None) -> dict:
+        steps = [self._step(step) for step in range(1, len(self.planes))]
+        used_colours = set()
+        with profiler.stage("encode"), PngWriter(
+            filename, self.width, self.height, self.palette, compress_level
+        ) as writer:
+            for top, bottom in self._bands():
+                band = self._blended_band(len(self.lookups), top, bottom)
+                used_colours.update(np.unique(band).tolist())
+                writer.write_rows(band.reshape(bottom - top, self.width))
+        Print.info(f"Actual           : {len(used_colours)}")
+        if self._temp_dir is not None:
+            self.planes = None
+            self._temp_dir.cleanup()
+        return dict(zip(self.image_paths, BlendImages.chain_recolour_dicts(steps)))
+
+
+def stream_blend(
+    image_paths: list[str],
+    filename: str,
+    memory_budget: int,
+    decode_cache=None,
+    reserved: frozenset = frozenset(),
+    compress_level: int = None,
+) -> dict:
+    return StreamBlend(image_paths, memory_budget, decode_cache, reserved).run(
+        filename, compress_level
+    )
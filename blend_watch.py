@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+from blend import (
+    Print,
+    ProcessImage,
+    RecolourTable,
+    chain_step,
+    check_inputs,
+    verify_blend,
+    verify_message,
+    write_image,
+    write_recolour_files,
+)
+from contextlib import redirect_stdout
+import io
+import os
+import time
+
+
+class WatchedJob:
+    # one job of the watch, keeping the pairwise chain after every image. A
+    # changed image only redoes the chain from its own step on, everything
+    # before it is still valid. `dirty` is the first input changed since the
+    # last blend that went through, a skipped or failed blend keeps it
+    def __init__(self, job: dict):
+        self.job = job
+        self.states = []
+        self.recolour_sprites = None
+        self.dirty = 0
+
+    def mark(self, changed: set) -> None:
+        for i, image_path in enumerate(self.job["inputs"][: self.dirty]):
+            if image_path in changed:
+                self.dirty = i
+                break
+
+    def blend(self, images: dict) -> int:
+        # re-blends from the first dirty input and returns its index
+        inputs = self.job["inputs"]
+        first = self.dirty
+        start = max(1, min(first, len(self.states)))
+        if start == 1:
+            self.states = [(images[inputs[0]], {inputs[0]: RecolourTable()})]
+        del self.states[start:]
+        # the per step colour counts would drown the one line per change
+        with redirect_stdout(io.StringIO()):
+            for i in range(start, len(inputs)):
+                self.states.append(
+                    chain_step(
+                        *self.states[-1],
+                        images[inputs[i]],
+                        inputs[i],
+                        self.job["engine"],
+                        self.job["reserved"],
+                    )
+                )
+        processed, self.recolour_sprites = self.states[-1]
+        write_image(self.job["output"], processed.spritemap, images[inputs[0]].palette)
+        self.dirty = len(inputs)
+        return first
+
+    def verify(self, images: dict) -> str:
+        inputs = self.job["inputs"]
+        failures = verify_blend(
+            inputs,
+            self.states[-1][0].spritemap,
+            self.recolour_sprites,
+            images=[images[image_path] for image_path in inputs],
+        )
+        return verify_message(failures) if failures else None
+
+
+class Watcher:
+    # polls the inputs of every job and keeps their decoded planes in memory,
+    # a change decodes that one file again and re-blends only the jobs using it
+    def __init__(self, jobs: list[dict], verify: bool = False):
+        self.jobs = [WatchedJob(job) for job in jobs]
+        self.verify = verify
+        self.images = {}
+        self.signatures = {}
+
+    @staticmethod
+    def _signature(image_path: str):
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load(self, image_path: str) -> bool:
+        # decodes now so a blend never waits on it, an editor may still be
+        # writing the file, then it is tried again on the next poll
+        image = ProcessImage(image_path)
+        try:
+            with redirect_stdout(io.StringIO()):
+                image.spritemap, image.palette
+        except SystemExit:
+            return False
+        self.images[image_path] = image
+        return True
+
+    def changed(self) -> set:
+        changed = set()
+        for watched in self.jobs:
+            for image_path in watched.job["inputs"]:
+                if image_path in changed:
+                    continue
+                signature = self._signature(image_path)
+                if signature is None or signature == self.signatures.get(image_path):
+                    continue
+                if self._load(image_path):
+                    self.signatures[image_path] = signature
+                    changed.add(image_path)
+        return changed
+
+    def update(self, changed: set) -> None:
+        recolour_files = set()
+        for watched in self.jobs:
+            job = watched.job
+            if not changed.intersection(job["inputs"]):
+                continue
+            watched.mark(changed)
+            start = time.perf_counter()
+            problems = check_inputs(job["inputs"])
+            if problems:
+                Print.warn(f"{job['name']}: " + "; ".join(problems))
+                continue
+            try:
+                first = watched.blend(self.images)
+            except SystemExit:
+                # Print.error already said why, keep watching
+                continue
+            message = None
+            if self.verify:
+                message = watched.verify(self.images)
+            milliseconds = (time.perf_counter() - start) * 1000
+            Print.info(
+                f"{time.strftime('%H:%M:%S')} {job['name']}: blended from image"
+                f" {first + 1} in {milliseconds:.1f} ms"
+            )
+            if message is not None:
+                Print.warn(message)
+            recolour_files.add(job["recolour"])
+
+        # a recolour file is rewritten whole, with every job that shares it
+        with redirect_stdout(io.StringIO()):
+            write_recolour_files(
+                {
+                    filename: [
+                        watched.recolour_sprites
+                        for watched in self.jobs
+                        if watched.job["recolour"] == filename
+                        and watched.recolour_sprites is not None
+                    ]
+                    for filename in recolour_files
+                }
+            )
+
+    def run(self, interval: float) -> None:
+        Print.info(f"Watching {len(self.jobs)} jobs, press Ctrl+C to stop")
+        try:
+            while True:
+                changed = self.changed()
+                if changed:
+                    self.update(changed)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            Print.info("Stopped watching")
+
+
+def run(
+    files: list[str],
+    *,
+    interval: float = 0.1,
+    engine: str = "pairkey",
+    reserved: frozenset = frozenset(),
+    verify: bool = False,
+) -> None:
+    # watches until interrupted, `files` are the images of one blend or a
+    # batch manifest
+    if len(files) == 1 and files[0].endswith((".json", ".toml")):
+        from blend_batch import load_manifest
+
+        jobs = load_manifest(files[0], reserved)
+        if engine != "pairkey":
+            for job in jobs:
+                job["engine"] = engine
+    else:
+        jobs = [
+            {
+                "name": "output.png",
+                "inputs": files,
+                "output": "output.png",
+                "recolour": "recolour.txt",
+                "engine": engine,
+                "reserved": reserved,
+            }
+        ]
+    for job in jobs:
+        problems = check_inputs(job["inputs"])
+        if problems:
+            Print.error(f"{job['name']}: " + "; ".join(problems))
+
+    Watcher(jobs, verify).run(interval)
+
+
+def main():
+    from blend_cli import script
+
+    script("watch")
+
+
+if __name__ == "__main__":
+    main()
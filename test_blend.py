@@ -0,0 +1,255 @@
+from blend import (
+    PaletteSlots,
+    ProcessImage,
+    RecolourTable,
+    check_inputs,
+    process_image,
+    verify_blend,
+    write_image,
+)
+from blend_bench import generate_images
+from blend_stream import stream_blend
+import os
+import pytest
+
+# low enough that the blends would hand these out otherwise
+RESERVED = PaletteSlots.parse("1-31,company")
+
+# every engine hands out palette slots in the same order, so all of them must
+# give byte-identical output. This pins the order colour sets are walked in
+# (assign_pairs and BlendImages._ordered_colours)
+CASES = {
+    "pair": dict(size=64, variants=2),
+    "triple": dict(size=64, variants=3, seed=1),
+    "many": dict(size=64, colours=12, variants=10, seed=2),
+    "reserved": dict(
+        size=64,
+        variants=3,
+        seed=3,
+        reserved=RESERVED,
+    ),
+}
+
+
+def _tables(recolour_sprites: dict, image_paths: list[str]) -> list[bytes]:
+    return [
+        bytes(RecolourTable.of(recolour_sprites[path]).data) for path in image_paths
+    ]
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_engines_agree(case, tmp_path):
+    settings = dict(CASES[case])
+    reserved = settings.pop("reserved", frozenset())
+    paths = generate_images(str(tmp_path), **settings)
+
+    spritemap, palette, recs = process_image(paths, "pairkey", reserved=reserved)
+    expected = (spritemap.tobytes(), _tables(recs, paths))
+    assert verify_blend(paths, spritemap, recs) == {}
+    assert palette == ProcessImage(paths[0]).palette
+
+    for engine, nway in (("reference", False), ("pairkey", True)):
+        spritemap, _, recs = process_image(paths, engine, nway, reserved=reserved)
+        assert (spritemap.tobytes(), _tables(recs, paths)) == expected, (engine, nway)
+
+    # small bands, so the stream runs over several of them
+    output = str(tmp_path / "stream.png")
+    recs = stream_blend(paths, output, 16 * 1024, reserved=reserved)
+    spritemap = ProcessImage(output).spritemap
+    assert (spritemap.tobytes(), _tables(recs, paths)) == expected
+    assert verify_blend(paths, spritemap, recs) == {}
+
+
+def test_reserved_indices_stay_free(tmp_path):
+    paths = generate_images(str(tmp_path), 64, variants=3, seed=3)
+    spritemap, _, _ = process_image(paths, reserved=RESERVED)
+    unreserved, _, _ = process_image(paths)
+    assert spritemap.tobytes() != unreserved.tobytes()
+    # a reserved index is only kept where it was the colour of every input
+    planes = [ProcessImage(path).spritemap.array() for path in paths]
+    output = spritemap.array()
+    for index in set(spritemap.data) & RESERVED:
+        for plane in planes:
+            assert (plane[output == index] == index).all()
+
+
+def test_decode_cache_clear_keeps_other_files(tmp_path):
+    from blend_cache import DecodeCache
+
+    DecodeCache(str(tmp_path / "missing")).report()
+    assert not (tmp_path / "missing").exists()
+
+    paths = generate_images(str(tmp_path), 32, variants=2)
+    decode_cache = DecodeCache(str(tmp_path))
+    assert decode_cache.size() == (0, 0)
+    process_image(paths, decode_cache=decode_cache)
+    assert decode_cache.size()[0] == len(paths)
+    decode_cache.clear()
+    assert decode_cache.size() == (0, 0)
+    assert all(os.path.exists(path) for path in paths)
+
+
+def test_result_cache_evicts_only_its_entries(tmp_path):
+    from blend_cache import ResultCache
+
+    paths = generate_images(str(tmp_path), 32, variants=2)
+    other = tmp_path / "my_data.npz"
+    other.write_bytes(b"not a cache entry")
+    cache = ResultCache(str(tmp_path), max_bytes=0)
+    cache.process_image(paths)
+    assert cache.evictions == 1
+    assert other.exists()
+
+
+def test_check_inputs_needs_a_palette(tmp_path):
+    from PIL import Image
+
+    paths = [str(tmp_path / f"{n}.png") for n in range(2)]
+    for path in paths:
+        Image.new("L", (8, 8)).save(path)
+    assert check_inputs(paths) == [
+        f"Image {path} is in L mode, not indexed" for path in paths
+    ]
+
+
+def test_result_cache_reuses_the_optimized_order(tmp_path):
+    from blend_cache import ResultCache
+
+    paths = generate_images(str(tmp_path), 32, variants=3, seed=4)
+    cache = ResultCache(str(tmp_path / "cache"))
+    ordered, images = cache.optimize_order(paths, 0.1)
+    assert sorted(ordered) == sorted(paths) and len(images) == len(paths)
+    cache.process_image(ordered, images=images)
+    assert cache.optimize_order(paths, 0.1) == (ordered, None)
+    cache.process_image(ordered)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_read_recolour_sprites():
+    from blend_compose import read_recolour_sprites
+
+    nml = """\
+// anything outside a block is skipped
+recolour_sprite {
+    // bus_red.png
+    0x01:0x02; 0x03:0x04;
+    0x10..0x13: 0x20..0x23; 0xC6 .. 0xC8 : 7;
+}
+recolour_sprite /* no
+   name */ {
+    5:6; /* a comment
+    0x07:0x08; still in it */ 9 : 10;
+}
+"""
+    (name, position, first), (unnamed, position2, second) = read_recolour_sprites(
+        nml.splitlines(keepends=True), "a.nml"
+    )
+    assert (name, position) == ("bus_red.png", "a.nml:0")
+    assert (unnamed, position2) == ("a.nml:1", "a.nml:1")
+    expected = bytearray(range(256))
+    expected[1], expected[3] = 2, 4
+    expected[0x10:0x14] = bytes(range(0x20, 0x24))
+    expected[0xC6:0xC9] = bytes([7]) * 3
+    assert first == expected
+    expected = bytearray(range(256))
+    expected[5], expected[9] = 6, 10
+    assert second == expected
+
+
+@pytest.mark.parametrize(
+    "entry",
+    ["0x100:0x01;", "0x01:256;", "0x05..0x04:0x01;", "0x01..0x03:0x10..0x11;"],
+)
+def test_read_recolour_sprites_rejects_bad_entries(entry):
+    from blend_compose import RecolourParseError, read_recolour_sprites
+
+    lines = ["recolour_sprite {\n", f"    0x02:0x03; {entry}\n", "}\n"]
+    with pytest.raises(RecolourParseError, match="a.nml:2"):
+        list(read_recolour_sprites(lines, "a.nml"))
+
+
+def test_compose_by_file_and_index(tmp_path):
+    from blend_compose import compose_chains, load_recolour_sprites
+
+    path = str(tmp_path / "r.nml")
+    with open(path, "w") as f:
+        f.write("recolour_sprite {\n    // x\n    1:2;\n}\n")
+        f.write("recolour_sprite {\n    2:3;\n}\n")
+    tables, ordered = load_recolour_sprites([path])
+    assert tables["x"] is tables[f"{path}:0"] and len(ordered) == 2
+    composed = compose_chains(tables, [("c", ["x", f"{path}:1"])])["c"]
+    # the last sprite of a chain applies first: 1 -> 1 -> 2 and 2 -> 3 -> 3
+    assert composed.data[1] == 2 and composed.data[2] == 3
+
+
+def _baseline_block(name, rec: dict) -> str:
+    # format_recolour_data as blend.py wrote it before RecolourWriter
+    s = "recolour_sprite {"
+    s += f"\n    // {name}"
+    counter = 0
+    for key, value in rec.items():
+        if key == value:
+            continue
+        if counter % 8 == 0:
+            s += "\n    "
+        s += f"0x{key:02x}:0x{value:02x};"
+        counter += 1
+    return s + "\n}\n"
+
+
+@pytest.mark.parametrize("changes", [0, 5, 8, 9, 17, 255])
+def test_recolour_writer_matches_baseline(changes):
+    import io
+    import random
+
+    from blend_core import RecolourWriter
+
+    rng = random.Random(changes)
+    rec = {i: i for i in range(256)}
+    for key in rng.sample(range(256), changes):
+        rec[key] = rng.choice([value for value in range(256) if value != key])
+    block = io.StringIO()
+    assert RecolourWriter(block).write("a.png", rec) == changes
+    assert block.getvalue() == _baseline_block("a.png", rec)
+    block = io.StringIO()
+    RecolourWriter(block).write("a.png", RecolourTable.of(rec))
+    assert block.getvalue() == _baseline_block("a.png", rec)
+
+
+def test_duplicate_jobs_reuse_a_result(tmp_path):
+    import shutil
+
+    from blend_batch import dedup_jobs, reuse_result
+
+    a, b = generate_images(str(tmp_path), 32, variants=2, seed=5)
+    a2, b2 = str(tmp_path / "copy_a.png"), str(tmp_path / "copy_b.png")
+    shutil.copyfile(a, a2)
+    shutil.copyfile(b, b2)
+
+    def job(name, inputs, reserved=frozenset()):
+        return {
+            "name": name,
+            "inputs": inputs,
+            "output": str(tmp_path / f"{name}.png"),
+            "recolour": str(tmp_path / f"{name}.nml"),
+            "reserved": reserved,
+            "optimize_order": None,
+        }
+
+    jobs = [
+        job("first", [a, b]),
+        job("copies", [a2, b2]),
+        job("swapped", [b, a]),
+        job("reserved", [a, b], RESERVED),
+    ]
+    assert dedup_jobs(jobs, range(len(jobs))) == {1: 0}
+
+    spritemap, palette, recs = process_image(jobs[0]["inputs"])
+    write_image(jobs[0]["output"], spritemap, palette)
+    result = {"name": "first", "ok": True, "error": None, "recolour": recs}
+    reused = reuse_result(jobs[1], jobs[0], result, False)
+    assert reused["ok"] and reused["duplicate_of"] == "first"
+    # named after the duplicate's own inputs, in the same order
+    assert list(reused["recolour"]) == [a2, b2]
+    assert _tables(reused["recolour"], [a2, b2]) == _tables(recs, [a, b])
+    assert ProcessImage(jobs[1]["output"]).spritemap.tobytes() == spritemap.tobytes()